@@ -0,0 +1,98 @@
+import threading
+import time
+from sqlalchemy import func, select
+
+# first key of the postgres advisory locks used as global slots
+admission_lock_key = 0x1cee5
+
+
+class AdmissionRejected(RuntimeError):
+    def __init__(self, message, retry_after):
+        RuntimeError.__init__(self, message)
+        self.retry_after = retry_after
+
+
+class Ticket():
+    def __init__(self, cost, conn=None, slot=None):
+        self.cost = cost
+        self.conn = conn
+        self.slot = slot
+
+
+class Admission():
+    """
+    Caps the estimated work (number of aggregate queries) running concurrently in this worker, and the number of
+    expensive requests running concurrently over all workers, using postgres advisory locks as slots. Requests wait
+    up to queue_timeout seconds for capacity and are then rejected.
+    """
+
+    def __init__(self, worker_budget, global_slots, threshold, queue_timeout, retry_after):
+        self.worker_budget = worker_budget
+        self.global_slots = global_slots
+        self.threshold = threshold
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.in_use = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, cost, get_engine):
+        # a request larger than the whole budget runs alone
+        cost = min(cost, self.worker_budget)
+        deadline = time.time() + self.queue_timeout
+        with self.condition:
+            while self.in_use + cost > self.worker_budget:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise AdmissionRejected("Server is busy. Please try again later.", self.retry_after)
+                self.condition.wait(remaining)
+            self.in_use += cost
+        ticket = Ticket(cost)
+        if self.global_slots > 0 and cost >= self.threshold:
+            try:
+                self.acquire_slot(ticket, get_engine(), deadline)
+            except Exception:
+                self.release(ticket)
+                raise
+        return ticket
+
+    def acquire_waiting(self, cost, get_engine, timeout):
+        # for background work, which waits up to timeout seconds for capacity instead of being rejected
+        end = time.time() + timeout
+        while True:
+            try:
+                return self.acquire(cost, get_engine)
+            except AdmissionRejected:
+                if time.time() >= end:
+                    raise
+
+    def acquire_slot(self, ticket, engine, deadline):
+        conn = engine.connect()
+        try:
+            while True:
+                for slot in range(self.global_slots):
+                    if conn.execute(select([func.pg_try_advisory_lock(admission_lock_key, slot)])).scalar():
+                        ticket.conn = conn
+                        ticket.slot = slot
+                        return
+                if time.time() >= deadline:
+                    raise AdmissionRejected("Server is busy. Please try again later.", self.retry_after)
+                time.sleep(0.1)
+        except Exception:
+            conn.close()
+            raise
+
+    def release(self, ticket):
+        try:
+            if ticket.conn is not None:
+                try:
+                    ticket.conn.execute(select([func.pg_advisory_unlock(admission_lock_key, ticket.slot)]))
+                except Exception:
+                    # do not return a connection that may still hold the lock to the pool
+                    ticket.conn.invalidate()
+                    raise
+                finally:
+                    ticket.conn.close()
+        finally:
+            with self.condition:
+                self.in_use -= ticket.cost
+                self.condition.notify_all()
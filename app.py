@@ -1,18 +1,32 @@
-from flask import Flask, request, make_response
+from flask import Flask, request, make_response, g, Response, stream_with_context
 from flask_restful import Resource, Api
 import json
-from model import get_features_by_id, select_feature_association, select_feature_matrix, get_db_connection, get_ids_by_feature, opposite, cohort_id_in_use, select_cohort, get_cohort_features, get_cohort_dictionary, service_name, get_cohort_by_id, validate_range, get_id_by_name, add_name_by_id
+from model import get_features_by_id, select_feature_association, select_feature_matrix, get_db_connection, get_ids_by_feature, opposite, cohort_id_in_use, select_cohort, get_cohort_features, get_cohort_dictionary, service_name, get_cohort_by_id, validate_range, get_id_by_name, add_name_by_id, get_aggregate_connection, get_read_connection, get_cohort_features_by_year, select_feature_matrix_by_year, select_feature_cube, stream_cohort_dictionary, to_qualifiers, deadline_statements
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
-from jsonschema import validate, ValidationError
-from schema import cohort_schema, feature_association_schema, feature_association2_schema, associations_to_all_features_schema, add_name_by_id_schema
+from jsonschema import ValidationError
+from schema import validator, load_artifact
 from flasgger import Swagger
 import traceback
 from format import format_tabular
+from cost import estimate_cost, estimate_queries
+from admission import Admission, AdmissionRejected
+from deadline import Deadline, timeouts, default_timeout
+from precompute import precompute, results, features_key, associations_key
+from jobs import submit_association_job, wait_for_job
+from diagnostics import slow_queries
+import hmac
+import base64
 import csv
+import gzip
+import hashlib
+import threading
 import logging
 from logging.handlers import TimedRotatingFileHandler
 import os
+import select
+import socket
+import ssl
 from time import strftime
 from structlog import wrap_logger
 from structlog.processors import JSONRenderer
@@ -20,19 +34,47 @@ from structlog.processors import JSONRenderer
 with open('terms.txt', 'r') as content_file:
     terms_and_conditions = content_file.read()
 
-logger = logging.getLogger("Rotating Log")
-logger.setLevel(logging.INFO)
+logger = None
 
-handler = TimedRotatingFileHandler(os.environ["ICEES_API_LOG_PATH"])
-
-logger.addHandler(handler)
-logger = wrap_logger(logger, processors=[JSONRenderer()])
+def get_logger():
+    # created on first use, in the worker process, so that importing the app needs no log path
+    global logger
+    if logger is None:
+        rotating_logger = logging.getLogger("Rotating Log")
+        rotating_logger.setLevel(logging.INFO)
+        handler = TimedRotatingFileHandler(os.environ["ICEES_API_LOG_PATH"])
+        rotating_logger.addHandler(handler)
+        logger = wrap_logger(rotating_logger, processors=[JSONRenderer()])
+    return logger
 
 app = Flask(__name__)
+
+rate_limit = os.environ.get("ICEES_RATELIMIT", "10/second")
+rate_limit_storage_uri = os.environ.get("ICEES_RATELIMIT_STORAGE_URI", "memory://")
+rate_limit_queries_per_token = int(os.environ.get("ICEES_RATELIMIT_QUERIES_PER_TOKEN", "100"))
+rate_limit_max_cost = int(os.environ.get("ICEES_RATELIMIT_MAX_COST", "10"))
+rate_limit_trust_forwarded = os.environ.get("ICEES_RATELIMIT_TRUST_FORWARDED", "false") == "true"
+rate_limit_trusted_proxies = int(os.environ.get("ICEES_RATELIMIT_TRUSTED_PROXIES", "1"))
+
+def client_key():
+    # each proxy appends the address it received the request from, entries left of those are set by the client
+    forwarded_for = request.headers.get("X-Forwarded-For")
+    if rate_limit_trust_forwarded and forwarded_for:
+        hops = [hop.strip() for hop in forwarded_for.split(",")]
+        if len(hops) >= rate_limit_trusted_proxies:
+            return hops[-rate_limit_trusted_proxies]
+    return get_remote_address()
+
+def request_cost():
+    view_args = request.view_args or {}
+    return estimate_cost(request.endpoint, view_args.get("table"), request.get_json(silent=True), rate_limit_queries_per_token, rate_limit_max_cost)
+
 limiter = Limiter(
-    app,
-    key_func=lambda: "client", # get_remote_address,
-    default_limits=["10/second"]
+    app=app,
+    key_func=client_key,
+    default_limits=[rate_limit],
+    default_limits_cost=request_cost,
+    storage_uri=rate_limit_storage_uri
 )
 
 app.config["SWAGGER"] = {
@@ -63,10 +105,71 @@ app.config["SWAGGER"] = {
   }'''
 }
 
+def request_timeout():
+    return timeouts.get(request.endpoint, default_timeout)
+
+def client_disconnected():
+    # gunicorn exposes the client socket, a disconnected client makes it readable with no data
+    sock = request.environ.get("gunicorn.socket")
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if len(readable) == 0:
+            return False
+        if isinstance(sock, ssl.SSLSocket):
+            # ssl sockets do not take recv flags, so peek at the tcp stream under the tls records on a duplicate of
+            # the socket
+            raw = socket.fromfd(sock.fileno(), sock.family, sock.type)
+            try:
+                return raw.recv(1, socket.MSG_PEEK) == b""
+            finally:
+                raw.close()
+        return sock.recv(1, socket.MSG_PEEK) == b""
+    except OSError:
+        return True
+
+def request_deadline(partial=False):
+    return Deadline(request_timeout(), client_disconnected, partial)
+
+def partial_response(data, deadline):
+    if deadline.expired:
+        return data, 200, {"X-ICEES-Partial": "true"}
+    else:
+        return data
+
+admission = Admission(
+    worker_budget=int(os.environ.get("ICEES_ADMISSION_WORKER_BUDGET", "5000")),
+    global_slots=int(os.environ.get("ICEES_ADMISSION_GLOBAL_SLOTS", "0")),
+    threshold=int(os.environ.get("ICEES_ADMISSION_THRESHOLD", "100")),
+    queue_timeout=float(os.environ.get("ICEES_ADMISSION_QUEUE_TIMEOUT", "10")),
+    retry_after=int(os.environ.get("ICEES_ADMISSION_RETRY_AFTER", "30"))
+)
+
+@app.before_request
+def admit_request():
+    view_args = request.view_args or {}
+    if "version" not in view_args or "table" not in view_args:
+        return None
+    queries = estimate_queries(request.endpoint, view_args["table"], request.get_json(silent=True))
+    try:
+        g.admission_ticket = admission.acquire(queries, lambda: get_db_connection(view_args["version"]))
+    except AdmissionRejected as e:
+        resp = make_response(json.dumps({"terms and conditions": terms_and_conditions, "return value": str(e)}), 503)
+        resp.headers["Retry-After"] = str(e.retry_after)
+        resp.headers["Content-Type"] = "application/json"
+        return resp
+
+@app.teardown_request
+def release_request(exc):
+    ticket = g.pop("admission_ticket", None)
+    if ticket is not None:
+        admission.release(ticket)
+
 @app.after_request
 def after_request(response):
     timestamp = strftime('%Y-%b-%d %H:%M:%S')
-    logger.info(event="request", timestamp=timestamp, remote_addr=request.remote_addr, method=request.method, schema=request.scheme, full_path=request.full_path, data=request.get_json(), response_status=response.status)
+    get_logger().info(event="request", timestamp=timestamp, remote_addr=request.remote_addr, method=request.method, schema=request.scheme, full_path=request.full_path, data=request.get_json(), response_status=response.status)
     return response
 
 api = Api(app)
@@ -148,18 +251,19 @@ class SERVCohort(Resource):
                 - import: "definitions/cohort_visit_output.yaml"
         """
         try:
-            conn = get_db_connection(version)
+            conn = get_db_connection(version, request_timeout())
             req_features = request.get_json()
             if req_features is None:
                 req_features = {}
             else:
-                validate(req_features, cohort_schema(table))
+                validator("cohort", table).validate(req_features)
 
             cohort_id, size = get_ids_by_feature(conn, table, year, req_features)
       
             if size == -1:
                 return "Input features invalid or cohort ≤10 patients. Please try again."
             else:
+                precompute(admission, version, table, year, cohort_id, req_features)
                 return {
                     "cohort_id": cohort_id,
                     "size": size
@@ -217,18 +321,19 @@ class SERVCohortId(Resource):
                 - import: "definitions/cohort_visit_output.yaml"
         """
         try:
-            conn = get_db_connection(version)
+            conn = get_db_connection(version, request_timeout())
             req_features = request.get_json()
             if req_features is None:
                 req_features = {}
             else:
-                validate(req_features, cohort_schema(table))
+                validator("cohort", table).validate(req_features)
 
             cohort_id, size = select_cohort(conn, table, year, req_features, cohort_id)
 
             if size == -1:
                 return "Input features invalid or cohort ≤10 patients. Please try again."
             else:
+                precompute(admission, version, table, year, cohort_id, req_features)
                 return {
                     "cohort_id": cohort_id,
                     "size": size
@@ -278,7 +383,7 @@ class SERVCohortId(Resource):
                 - import: "definitions/cohort_visit_input.yaml"
         """
         try:
-            conn = get_db_connection(version)
+            conn = get_db_connection(version, request_timeout())
             cohort_features = get_cohort_by_id(conn, table, year, cohort_id)
             
             if cohort_features is None:
@@ -293,14 +398,6 @@ class SERVCohortId(Resource):
             return str(e)
 
 
-def to_qualifiers(feature):
-    k, v = list(feature.items())[0]
-    return {
-        "feature_name": k,
-        "feature_qualifiers": [v, opposite(v)]
-    }
-
-
 class SERVFeatureAssociation(Resource):
     def post(self, version, table, year, cohort_id):
         """
@@ -348,17 +445,18 @@ class SERVFeatureAssociation(Resource):
         """
         try:
             obj = request.get_json()
-            validate(obj, feature_association_schema(table))
+            validator("feature_association", table).validate(obj)
             feature_a = to_qualifiers(obj["feature_a"])
             feature_b = to_qualifiers(obj["feature_b"])
 
-            conn = get_db_connection(version)
+            conn = get_db_connection(version, request_timeout())
             cohort_features = get_features_by_id(conn, table, year, cohort_id)
 
             if cohort_features is None:
                 return "Input cohort_id invalid. Please try again."
             else:
-                return select_feature_matrix(conn, table, year, cohort_features, feature_a, feature_b)
+                aggregate_conn, aggregate_cohort_id = get_aggregate_connection(conn, version, request_timeout(), cohort_id)
+                return select_feature_matrix(aggregate_conn, table, year, cohort_features, feature_a, feature_b, aggregate_cohort_id)
         except ValidationError as e:
             traceback.print_exc()
             return e.message
@@ -421,7 +519,7 @@ class SERVFeatureAssociation2(Resource):
         """
         try:
             obj = request.get_json()
-            validate(obj, feature_association2_schema(table))
+            validator("feature_association2", table).validate(obj)
             feature_a = to_qualifiers2(obj["feature_a"])
             feature_b = to_qualifiers2(obj["feature_b"])
             to_validate_range = ("check_coverage_is_full" in obj) and obj["check_coverage_is_full"]
@@ -429,13 +527,79 @@ class SERVFeatureAssociation2(Resource):
                 validate_range(table, feature_a)
                 validate_range(table, feature_b)
 
-            conn = get_db_connection(version)
+            conn = get_db_connection(version, request_timeout())
+            cohort_features = get_features_by_id(conn, table, year, cohort_id)
+
+            if cohort_features is None:
+                return "Input cohort_id invalid. Please try again."
+            else:
+                aggregate_conn, aggregate_cohort_id = get_aggregate_connection(conn, version, request_timeout(), cohort_id)
+                return select_feature_matrix(aggregate_conn, table, year, cohort_features, feature_a, feature_b, aggregate_cohort_id)
+        except ValidationError as e:
+            traceback.print_exc()
+            return e.message
+        except Exception as e:
+            traceback.print_exc()
+            return str(e)
+
+
+class SERVFeatureCube(Resource):
+    def post(self, version, table, year, cohort_id):
+        """
+        Stratified feature tables: users select a predefined cohort and any number of feature variables with bins, and the service returns the K-dimensional table of counts for every combination of bins, and the marginal counts over the chosen subsets of the features, computed in one scan. By default the marginals of each feature are returned.
+        ---
+        parameters:
+          - in: body
+            name: body
+            description: a list of feature variables and bins, and a list of marginals as lists of feature indices
+            schema:
+              oneOf:
+                - import: "definitions/feature_cube_patient_input.yaml"
+                - import: "definitions/feature_cube_visit_input.yaml"
+          - in: path
+            name: version
+            required: true
+            description: version of data 1.0.0
+            type: string
+            default: 1.0.0
+          - in: path
+            name: table
+            required: true
+            description: the table patient|visit
+            type: string
+            default: patient
+          - in: path
+            name: year
+            required: true
+            description: the year 2010
+            type: integer
+            default: 2010
+          - in: path
+            name: cohort_id
+            required: true
+            description: the cohort id
+            type: string
+            default: COHORT:22
+        responses:
+          200:
+            description: The feature cube
+            schema:
+              oneOf:
+                - import: "definitions/feature_cube_patient_output.yaml"
+                - import: "definitions/feature_cube_visit_output.yaml"
+        """
+        try:
+            obj = request.get_json()
+            validator("feature_cube", table).validate(obj)
+            feature_list = list(map(to_qualifiers2, obj["features"]))
+            conn = get_db_connection(version, request_timeout())
             cohort_features = get_features_by_id(conn, table, year, cohort_id)
 
             if cohort_features is None:
                 return "Input cohort_id invalid. Please try again."
             else:
-                return select_feature_matrix(conn, table, year, cohort_features, feature_a, feature_b)
+                aggregate_conn, aggregate_cohort_id = get_aggregate_connection(conn, version, request_timeout(), cohort_id)
+                return select_feature_cube(aggregate_conn, table, year, cohort_features, feature_list, obj.get("marginals"), aggregate_cohort_id)
         except ValidationError as e:
             traceback.print_exc()
             return e.message
@@ -491,15 +655,132 @@ class SERVAssociationsToAllFeatures(Resource):
         """
         try:
             obj = request.get_json()
-            validate(obj, associations_to_all_features_schema(table))
+            validator("associations_to_all_features", table).validate(obj)
+            feature = to_qualifiers(obj["feature"])
+            maximum_p_value = obj["maximum_p_value"]
+            deadline = request_deadline(obj.get("partial", False))
+            conn = get_db_connection(version, request_timeout())
+            cohort_features = get_features_by_id(conn, table, year, cohort_id)
+            if cohort_features is None:
+                return "Input cohort_id invalid. Please try again."
+            rs = results.get(associations_key(version, table, year, cohort_features, feature), deadline.remaining()) if obj.get("sample_fraction") is None else None
+            if rs is not None:
+                return [r for r in rs if r["p_value"] < maximum_p_value]
+            else:
+                aggregate_conn, aggregate_cohort_id = get_aggregate_connection(conn, version, request_timeout(), cohort_id)
+                with deadline_statements(deadline):
+                    rs = select_feature_association(aggregate_conn, table, year, cohort_features, feature, maximum_p_value, aggregate_cohort_id, deadline, obj.get("sample_fraction"), obj.get("exact_top", 0))
+                return partial_response(rs, deadline)
+        except ValidationError as e:
+            traceback.print_exc()
+            return e.message
+        except Exception as e:
+            traceback.print_exc()
+            return str(e)
+
+
+class SERVCohortYears(Resource):
+    def post(self, version, table):
+        """
+        Cross-year cohort comparison: users define a cohort and a list of years, and the service returns the cohort's size and feature profile, or the N x N feature table of two feature variables with a Chi Square statistic and P value, for each year, counted in one scan grouped by year. Years where the cohort has 10 or fewer patients are null.
+        ---
+        parameters:
+          - in: body
+            name: body
+            description: years, feature variables and optionally two feature variables and bins
+            schema:
+              oneOf:
+                - import: "definitions/cohort_years_patient_input.yaml"
+                - import: "definitions/cohort_years_visit_input.yaml"
+          - in: path
+            name: version
+            required: true
+            description: version of data 1.0.0
+            type: string
+            default: 1.0.0
+          - in: path
+            name: table
+            required: true
+            description: the table patient|visit
+            type: string
+            default: patient
+        responses:
+          200:
+            description: The cohort by year
+            schema:
+              oneOf:
+                - import: "definitions/cohort_years_patient_output.yaml"
+                - import: "definitions/cohort_years_visit_output.yaml"
+        """
+        try:
+            obj = request.get_json()
+            validator("cohort_years", table).validate(obj)
+            conn = get_read_connection(version, request_timeout())
+            if "feature_a" in obj:
+                return select_feature_matrix_by_year(conn, table, obj["years"], obj["cohort_features"], to_qualifiers2(obj["feature_a"]), to_qualifiers2(obj["feature_b"]))
+            else:
+                return get_cohort_features_by_year(conn, table, obj["years"], obj["cohort_features"])
+        except ValidationError as e:
+            traceback.print_exc()
+            return e.message
+        except Exception as e:
+            traceback.print_exc()
+            return str(e)
+
+
+class SERVAssociationsToAllFeaturesJob(Resource):
+    def post(self, version, table, year, cohort_id):
+        """
+        Exploratory 1 X N feature associations as a job: takes the same input as associations_to_all_features, and the service returns a job id immediately and computes the associations in the background. Get the progress and result from the job endpoint.
+        ---
+        parameters:
+          - in: body
+            name: body
+            description: a feature variable and minimum p value
+            schema:
+              oneOf:
+                - import: "definitions/associations_to_all_features_patient_input.yaml"
+                - import: "definitions/associations_to_all_features_visit_input.yaml"
+          - in: path
+            name: version
+            required: true
+            description: version of data 1.0.0
+            type: string
+            default: 1.0.0
+          - in: path
+            name: table
+            required: true
+            description: the table patient|visit
+            type: string
+            default: patient
+          - in: path
+            name: year
+            required: true
+            description: the year 2010
+            type: integer
+            default: 2010
+          - in: path
+            name: cohort_id
+            required: true
+            description: the cohort id
+            type: string
+            default: COHORT:22
+        responses:
+          202:
+            description: The job id
+        """
+        try:
+            obj = request.get_json()
+            validator("associations_to_all_features", table).validate(obj)
             feature = to_qualifiers(obj["feature"])
             maximum_p_value = obj["maximum_p_value"]
-            conn = get_db_connection(version)
+            conn = get_db_connection(version, request_timeout())
             cohort_features = get_features_by_id(conn, table, year, cohort_id)
             if cohort_features is None:
                 return "Input cohort_id invalid. Please try again."
             else:
-                return select_feature_association(conn, table, year, cohort_features, feature, maximum_p_value)
+                job_id = submit_association_job(conn, admission, version, table, year, cohort_id, cohort_features, feature, maximum_p_value, obj.get("sample_fraction"), obj.get("exact_top", 0))
+                return {"job_id": job_id}, 202
         except ValidationError as e:
             traceback.print_exc()
             return e.message
@@ -508,6 +789,51 @@ class SERVAssociationsToAllFeatures(Resource):
             return str(e)
 
 
+class SERVJob(Resource):
+    def get(self, version, table, job_id):
+        """
+        Get the status of a job, the number of features completed out of the total, and the result when the job is done.
+        ---
+        parameters:
+          - in: path
+            name: version
+            required: true
+            description: version of data 1.0.0
+            type: string
+            default: 1.0.0
+          - in: path
+            name: table
+            required: true
+            description: the table patient|visit
+            type: string
+            default: patient
+          - in: path
+            name: job_id
+            required: true
+            description: the job id
+            type: string
+          - in: query
+            name: wait
+            required: false
+            description: seconds to wait for the job to finish
+            type: number
+        responses:
+          200:
+            description: The job
+        """
+        try:
+            wait = min(request.args.get("wait", 0, type=float), request_timeout())
+            conn = get_db_connection(version, request_timeout())
+            ret = wait_for_job(conn, job_id, wait)
+            if ret is None:
+                return "Input job_id invalid or expired. Please try again."
+            else:
+                return ret
+        except Exception as e:
+            traceback.print_exc()
+            return str(e)
+
+
 class SERVFeatures(Resource):
     def get(self, version, table, year, cohort_id):
         """
@@ -538,6 +864,12 @@ class SERVFeatures(Resource):
             description: the cohort id
             type: string
             default: COHORT:22
+          - in: query
+            name: partial
+            required: false
+            description: return the features computed so far instead of an error when the time budget is exceeded
+            type: boolean
+            default: false
         responses:
           200:
             description: features
@@ -547,12 +879,21 @@ class SERVFeatures(Resource):
                 - import: "definitions/features_visit_output.yaml"
         """
         try:
-            conn = get_db_connection(version)
+            deadline = request_deadline(request.args.get("partial") == "true")
+            conn = get_db_connection(version, request_timeout())
             cohort_features = get_features_by_id(conn, table, year, cohort_id)
             if cohort_features is None:
                 return "Input cohort_id invalid. Please try again."
             else:
-                return get_cohort_features(conn, table, year, cohort_features)
+                key = features_key(version, table, year, cohort_features)
+                rs = results.get(key, deadline.remaining())
+                if rs is None:
+                    aggregate_conn, aggregate_cohort_id = get_aggregate_connection(conn, version, request_timeout(), cohort_id)
+                    with deadline_statements(deadline):
+                        rs = get_cohort_features(aggregate_conn, table, year, cohort_features, aggregate_cohort_id, deadline)
+                    if not deadline.expired:
+                        results.put(key, rs)
+                return partial_response(rs, deadline)
         except ValidationError as e:
             traceback.print_exc()
             return e.message
@@ -561,6 +902,26 @@ class SERVFeatures(Resource):
             return str(e)
 
 
+def encode_cursor(cohort_id):
+    return base64.urlsafe_b64encode(cohort_id.encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor):
+    try:
+        return base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+    except (ValueError, UnicodeError):
+        raise RuntimeError("Input cursor invalid. Please try again.")
+
+def stream_cohort_dictionary_response(version, table, year, after):
+    engine = get_db_connection(version, request_timeout())
+    def generate():
+        with engine.connect() as conn:
+            yield '{"terms and conditions": ' + json.dumps(terms_and_conditions) + ', "return value": ['
+            for i, entry in enumerate(stream_cohort_dictionary(conn, table, year, after)):
+                yield ("," if i > 0 else "") + entry
+            yield "]}"
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
+
 class SERVCohortDictionary(Resource):
     def get(self, version, table, year):
         """
@@ -585,6 +946,21 @@ class SERVCohortDictionary(Resource):
             description: the year 2010|2011
             type: integer
             default: 2010
+          - in: query
+            name: limit
+            required: false
+            description: the number of cohorts in a page, the next page starts at the cursor in the X-ICEES-Next-Cursor header
+            type: integer
+          - in: query
+            name: cursor
+            required: false
+            description: the cursor of the page
+            type: string
+          - in: query
+            name: stream
+            required: false
+            description: true to stream all cohorts after the cursor as json
+            type: boolean
         responses:
           200:
             description: cohort dictionray
@@ -594,8 +970,19 @@ class SERVCohortDictionary(Resource):
                 - import: "definitions/cohort_dictionary_visit_output.yaml"
         """
         try:
-            conn = get_db_connection(version)
-            return get_cohort_dictionary(conn, table, year)
+            limit = request.args.get("limit", type=int)
+            cursor = request.args.get("cursor")
+            after = decode_cursor(cursor) if cursor is not None else None
+            if request.args.get("stream") == "true":
+                return stream_cohort_dictionary_response(version, table, year, after)
+            if limit is not None and limit <= 0:
+                return "Input limit invalid. Please try again."
+            conn = get_db_connection(version, request_timeout())
+            rs = get_cohort_dictionary(conn, table, year, limit, after)
+            if limit is not None and len(rs) == limit:
+                return rs, 200, {"X-ICEES-Next-Cursor": encode_cursor(rs[-1]["cohort_id"])}
+            else:
+                return rs
         except ValidationError as e:
             traceback.print_exc()
             return e.message
@@ -702,7 +1089,7 @@ class SERVName(Resource):
               import: "definitions/name_output.yaml"
         """
         try:
-            conn = get_db_connection(version)
+            conn = get_db_connection(version, request_timeout())
             return get_id_by_name(conn, table, name)
         except ValidationError as e:
             traceback.print_exc()
@@ -747,8 +1134,8 @@ class SERVName(Resource):
         """
         try:
             obj = request.get_json()
-            validate(obj, add_name_by_id_schema())
-            conn = get_db_connection(version)
+            validator("add_name_by_id").validate(obj)
+            conn = get_db_connection(version, request_timeout())
             return add_name_by_id(conn, table, name, obj["cohort_id"])
         except ValidationError as e:
             traceback.print_exc()
@@ -758,16 +1145,80 @@ class SERVName(Resource):
             return str(e)
 
 
+admin_token = os.environ.get("ICEES_ADMIN_TOKEN")
+
+class SERVSlowQueries(Resource):
+    def get(self):
+        """
+        Get the most recent slow queries, with their plans. Requires the X-ICEES-Admin-Token header.
+        ---
+        parameters:
+          - in: header
+            name: X-ICEES-Admin-Token
+            required: true
+            type: string
+        responses:
+          200:
+            description: The slow queries
+        """
+        token = request.headers.get("X-ICEES-Admin-Token")
+        if admin_token is None or token is None or not hmac.compare_digest(token, admin_token):
+            return "Forbidden.", 403
+        return slow_queries()
+
+
 api.add_resource(SERVCohort, '/<string:version>/<string:table>/<int:year>/cohort')
 api.add_resource(SERVCohortId, '/<string:version>/<string:table>/<int:year>/cohort/<string:cohort_id>')
 api.add_resource(SERVFeatures, '/<string:version>/<string:table>/<int:year>/cohort/<string:cohort_id>/features')
 api.add_resource(SERVCohortDictionary, '/<string:version>/<string:table>/<int:year>/cohort/dictionary')
 api.add_resource(SERVFeatureAssociation, '/<string:version>/<string:table>/<int:year>/cohort/<string:cohort_id>/feature_association')
 api.add_resource(SERVFeatureAssociation2, '/<string:version>/<string:table>/<int:year>/cohort/<string:cohort_id>/feature_association2')
+api.add_resource(SERVFeatureCube, '/<string:version>/<string:table>/<int:year>/cohort/<string:cohort_id>/feature_cube')
 api.add_resource(SERVAssociationsToAllFeatures, '/<string:version>/<string:table>/<int:year>/cohort/<string:cohort_id>/associations_to_all_features')
+api.add_resource(SERVAssociationsToAllFeaturesJob, '/<string:version>/<string:table>/<int:year>/cohort/<string:cohort_id>/associations_to_all_features/job')
+api.add_resource(SERVJob, '/<string:version>/<string:table>/job/<string:job_id>')
+api.add_resource(SERVCohortYears, '/<string:version>/<string:table>/cohort/years')
+api.add_resource(SERVSlowQueries, "/admin/slow_queries")
 api.add_resource(SERVIdentifiers, "/<string:version>/<string:table>/<string:feature>/identifiers")
 api.add_resource(SERVName, "/<string:version>/<string:table>/name/<string:name>")
 
+apispec = None
+apispec_lock = threading.Lock()
+
+def get_apispec():
+    # the spec is taken from the build artifact, or assembled by flasgger once per worker, and kept as
+    # json and gzipped json with an etag
+    global apispec
+    with apispec_lock:
+        if apispec is None:
+            spec = load_artifact().get("apispec")
+            if spec is None:
+                spec = swag.get_apispecs("apispec_1")
+            body = json.dumps(spec).encode("utf-8")
+            apispec = {
+                "body": body,
+                "gzip": gzip.compress(body),
+                "etag": hashlib.sha256(body).hexdigest()
+            }
+    return apispec
+
+def serve_apispec():
+    spec = get_apispec()
+    if spec["etag"] in request.if_none_match:
+        resp = make_response("", 304)
+    elif request.accept_encodings["gzip"]:
+        resp = make_response(spec["gzip"])
+        resp.headers["Content-Encoding"] = "gzip"
+    else:
+        resp = make_response(spec["body"])
+    resp.headers["Content-Type"] = "application/json"
+    resp.set_etag(spec["etag"])
+    resp.headers["Vary"] = "Accept-Encoding"
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+app.view_functions["flasgger.apispec_1"] = serve_apispec
+
 if __name__ == '__main__':
 
     app.run()
@@ -0,0 +1,26 @@
+import json
+import time
+from schema import generate_schema, build_schemas, artifact_path
+
+
+def build_apispec():
+    # the spec flasgger assembles from the docstrings in app.py and the yaml files in definitions
+    from app import app, swag
+    with app.test_request_context():
+        return swag.get_apispecs("apispec_1")
+
+
+def build():
+    generate_schema()
+    artifact = {
+        "schemas": build_schemas(),
+        "apispec": build_apispec()
+    }
+    with open(artifact_path, "w") as f:
+        json.dump(artifact, f)
+
+
+if __name__ == '__main__':
+    start = time.time()
+    build()
+    print("built {0} in {1:.1f}s".format(artifact_path, time.time() - start))
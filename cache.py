@@ -0,0 +1,72 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class ResultCache():
+    """
+    In-process cache of computed results, keeping at most max_entries results for ttl seconds, evicting the least
+    recently used first. A computation is registered while it runs, so that requests for its result wait for it
+    instead of starting another.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.in_flight = {}
+        self.lock = threading.RLock()
+
+    def cached(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires <= time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def get(self, key, timeout=None):
+        # the cached result, waiting up to timeout seconds for a running computation, or None
+        with self.lock:
+            value = self.cached(key)
+            future = self.in_flight.get(key)
+        if value is None and future is not None:
+            try:
+                value = future.result(timeout)
+            except Exception:
+                value = None
+        return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def start(self, key):
+        # registers a computation of key and returns its future, or None if key is cached or already being computed
+        with self.lock:
+            if self.cached(key) is not None or key in self.in_flight:
+                return None
+            future = Future()
+            self.in_flight[key] = future
+            return future
+
+    def finish(self, key, future, value=None, exception=None):
+        with self.lock:
+            del self.in_flight[key]
+            if exception is None:
+                self.put(key, value)
+        if exception is None:
+            future.set_result(value)
+        else:
+            future.set_exception(exception)
+
+    def pending(self):
+        with self.lock:
+            return len(self.in_flight)
@@ -0,0 +1,77 @@
+import math
+from features import features
+
+# levels assumed for features whose levels are only known from the data
+default_levels = 10
+
+
+def feature_levels(table_name, feature_name):
+    for k, _, levels, _ in features[table_name]:
+        if k == feature_name:
+            return len(levels) if levels is not None else default_levels
+    return default_levels
+
+
+def all_feature_levels(table_name):
+    return [len(levels) if levels is not None else default_levels for _, _, levels, _ in features[table_name]]
+
+
+def matrix_queries(na, nb):
+    # cells, column totals, row totals and the total
+    return na * nb + na + nb + 1
+
+
+def number_of_bins(feature):
+    if not isinstance(feature, dict) or len(feature) == 0:
+        return 0
+    return len(list(feature.values())[0])
+
+
+def cube_cells(obj):
+    # the cells of the cube and of its marginals, each marginal of one feature by default
+    features = obj.get("features")
+    if not isinstance(features, list) or len(features) == 0:
+        return 1
+    shapes = [number_of_bins(feature) for feature in features]
+    marginals = obj.get("marginals")
+    if not isinstance(marginals, list):
+        marginals = [[i] for i in range(len(shapes))]
+    cells = 1
+    for shape in shapes:
+        cells *= shape
+    for marginal in marginals:
+        if isinstance(marginal, list):
+            marginal_cells = 1
+            for i in set(marginal):
+                marginal_cells *= shapes[i] if isinstance(i, int) and 0 <= i < len(shapes) else 1
+            cells += marginal_cells
+    return cells
+
+
+def estimate_queries(endpoint, table_name, obj):
+    # the number of aggregate queries the endpoint issues for a request body
+    if table_name not in features:
+        return 1
+    if endpoint == "servfeatures":
+        return sum(n + 1 for n in all_feature_levels(table_name))
+    elif endpoint == "servfeatureassociation":
+        return matrix_queries(2, 2)
+    elif endpoint == "servfeatureassociation2":
+        obj = obj or {}
+        return matrix_queries(number_of_bins(obj.get("feature_a")), number_of_bins(obj.get("feature_b")))
+    elif endpoint in ["servassociationstoallfeatures", "servassociationstoallfeaturesjob"]:
+        return sum(matrix_queries(2, n) for n in all_feature_levels(table_name))
+    elif endpoint == "servfeaturecube":
+        # one scan, charged like the per cell queries it replaces
+        return cube_cells(obj or {})
+    elif endpoint == "servcohortyears":
+        # one grouped scan per year
+        obj = obj or {}
+        years = obj.get("years")
+        return len(years) if isinstance(years, list) and len(years) > 0 else 1
+    else:
+        return 1
+
+
+def estimate_cost(endpoint, table_name, obj, queries_per_token, max_cost):
+    return min(max_cost, max(1, int(math.ceil(estimate_queries(endpoint, table_name, obj) / float(queries_per_token)))))
@@ -0,0 +1,47 @@
+import json
+import os
+import time
+
+# time budgets of the endpoints in seconds, gunicorn.conf.py keeps the worker timeout above the largest
+default_timeouts = {
+    "servfeatures": 300,
+    "servassociationstoallfeatures": 600,
+    "servcohortyears": 300
+}
+timeouts = json.loads(os.environ.get("ICEES_TIMEOUTS", json.dumps(default_timeouts)))
+default_timeout = float(os.environ.get("ICEES_DEFAULT_TIMEOUT", "60"))
+
+
+class DeadlineExceeded(RuntimeError):
+    pass
+
+
+class RequestCancelled(RuntimeError):
+    pass
+
+
+class Deadline():
+    """
+    Time budget of a request, checked between the per-feature iterations of long running queries. When partial is
+    set, an expired deadline stops the iterations and the results computed so far are returned instead of an error.
+    """
+
+    def __init__(self, seconds=None, is_cancelled=None, partial=False):
+        self.seconds = seconds
+        self.end = time.time() + seconds if seconds is not None else None
+        self.is_cancelled = is_cancelled
+        self.partial = partial
+        self.expired = False
+
+    def remaining(self):
+        return max(0, self.end - time.time()) if self.end is not None else None
+
+    def check(self):
+        if self.is_cancelled is not None and self.is_cancelled():
+            raise RequestCancelled("Request cancelled by client.")
+        if self.end is not None and time.time() > self.end:
+            self.expired = True
+            if not self.partial:
+                raise DeadlineExceeded("Request exceeded its time budget of " + str(self.seconds) + " seconds. Please try again with a smaller request.")
+            return False
+        return True
@@ -0,0 +1,113 @@
+import collections
+import datetime
+import json
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import RotatingFileHandler
+from sqlalchemy import event
+
+# statements slower than this many seconds are recorded, unset disables the diagnostics
+slow_query_threshold = os.environ.get("ICEES_SLOW_QUERY_THRESHOLD")
+slow_query_threshold = float(slow_query_threshold) if slow_query_threshold is not None else None
+slow_query_log_path = os.environ.get("ICEES_SLOW_QUERY_LOG_PATH")
+slow_query_max_explains = int(os.environ.get("ICEES_SLOW_QUERY_MAX_EXPLAINS_PER_MINUTE", "6"))
+slow_query_keep = int(os.environ.get("ICEES_SLOW_QUERY_KEEP", "100"))
+
+records = collections.deque(maxlen=slow_query_keep)
+
+# the count and aggregate queries read the data tables
+data_tables = re.compile(r'\b(FROM|JOIN)\s+"?(patient|visit)"?(\s|$)', re.IGNORECASE)
+
+# functions that change state even in a select, such as allocating cohort ids or taking the admission locks
+side_effect_functions = re.compile(r'\b(nextval|setval|pg_(try_)?advisory\w*)\s*\(', re.IGNORECASE)
+
+explain_times = collections.deque()
+
+lock = threading.Lock()
+
+executor = None
+
+logger = None
+
+
+def get_logger():
+    global logger
+    if logger is None:
+        logger = logging.getLogger("Slow Queries")
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        if slow_query_log_path is not None:
+            logger.addHandler(RotatingFileHandler(slow_query_log_path, maxBytes=10 * 1024 * 1024, backupCount=5))
+    return logger
+
+
+def allow_explain():
+    # at most slow_query_max_explains explains in any minute
+    now = time.time()
+    with lock:
+        while len(explain_times) > 0 and explain_times[0] <= now - 60:
+            explain_times.popleft()
+        if len(explain_times) >= slow_query_max_explains:
+            return False
+        explain_times.append(now)
+        return True
+
+
+def write(record):
+    get_logger().info(json.dumps(record, default=str))
+
+
+def explainable(statement):
+    # only statements that read the data tables and call no functions with side effects are run again
+    return statement.lstrip().upper().startswith("SELECT") and data_tables.search(statement) is not None and side_effect_functions.search(statement) is None
+
+
+def explain(engine, record, statement, parameters):
+    # runs the statement again, under EXPLAIN ANALYZE, on a connection of its own
+    try:
+        with engine.connect() as conn:
+            plan = conn.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + statement, parameters).scalar()
+        record["plan"] = plan
+    except Exception as e:
+        record["plan_error"] = str(e)
+    write(record)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context.query_start = time.time()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    global executor
+    duration = time.time() - context.query_start
+    if duration < slow_query_threshold or statement.lstrip().upper().startswith("EXPLAIN"):
+        return
+    record = {
+        "time": datetime.datetime.utcnow().isoformat(),
+        "duration": duration,
+        "statement": statement,
+        "parameters": parameters
+    }
+    records.append(record)
+    if explainable(statement) and not executemany and allow_explain():
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=1)
+        executor.submit(explain, conn.engine, record, statement, parameters)
+    else:
+        write(record)
+
+
+def instrument(engine):
+    if slow_query_threshold is not None:
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", after_cursor_execute)
+    return engine
+
+
+def slow_queries():
+    # most recent first
+    return list(reversed(records))
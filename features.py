@@ -144,12 +144,12 @@ features = {
         ("FlunisolideVisit", Integer, boolean_levels, "DrugExposure"),
         ("AlbuterolVisit", Integer, boolean_levels, "DrugExposure"),
         ("MetaproterenolVisit", Integer, boolean_levels, "DrugExposure"),
-        ("DiphenhydramineVisit", Integer, boolean_levels, "DrugExposure")
+        ("DiphenhydramineVisit", Integer, boolean_levels, "DrugExposure"),
         ("FexofenadineVisit", Integer, boolean_levels, "DrugExposure"),
         ("CetirizineVisit", Integer, boolean_levels, "DrugExposure"),
         ("IpratropiumVisit", Integer, boolean_levels, "DrugExposure"),
         ("SalmeterolVisit", Integer, boolean_levels, "DrugExposure"),
-        ("ArformoterolVisit", Integer, boolean_levels, "DrugExposure")
+        ("ArformoterolVisit", Integer, boolean_levels, "DrugExposure"),
         ("FormoterolVisit", Integer, boolean_levels, "DrugExposure"),
         ("IndacaterolVisit", Integer, boolean_levels, "DrugExposure"),
         ("TheophyllineVisit", Integer, boolean_levels, "DrugExposure"),
@@ -161,5 +161,5 @@ features = {
 def lookUpFeatureClass(table, feature):
     for n, _, _, c in features[table]:
         if n == feature:
-            return C
+            return c
     return None
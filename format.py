@@ -1,5 +1,3 @@
-from tabulate import tabulate
-
 def feature_to_text(feature_name, feature_qualifier):
     op_form = {
         ">": lambda x: str(x["value"]),
@@ -15,6 +13,7 @@ def feature_to_text(feature_name, feature_qualifier):
 
 
 def table_to_text(columns, rows):
+    from tabulate import tabulate
     return tabulate(rows, columns, tablefmt="grid")
 
 
@@ -34,6 +33,7 @@ def percentage_to_text(cell):
 
 
 def total_to_text(cell):
+    from tabulate import tabulate
     return tabulate([
         [cell["frequency"]
     ], [
@@ -42,6 +42,7 @@ def total_to_text(cell):
 
 
 def cell_to_text(cell):
+    from tabulate import tabulate
     return tabulate([
         [
             cell["frequency"], percentage_to_text(cell["row_percentage"])
@@ -56,6 +57,33 @@ def format_tables(data, tables):
         columns = ["error"]
         rows = [[str(data)]]
         tables.append([columns, rows])
+    elif isinstance(data, dict) and len(data) > 0 and all(isinstance(k, int) for k in data):
+        for year, d in sorted(data.items()):
+            if d is None:
+                tables.append([["year", "size"], [[year, "≤10"]]])
+            elif "feature_a" in d:
+                tables.append([["year"], [[year]]])
+                format_tables(d, tables)
+            else:
+                tables.append([["year", "size"], [[year, d["size"]]]])
+                format_tables(d["features"], tables)
+    elif "job_id" in data:
+        columns = ["job_id", "status", "completed", "total"]
+        rows = [[data["job_id"], data.get("status"), data.get("completed"), data.get("total")]]
+        tables.append([columns, rows])
+        if "result" in data:
+            format_tables(data["result"], tables)
+        elif "error" in data:
+            format_tables(data["error"], tables)
+    elif "cube" in data:
+        dimensions = data["dimensions"]
+        for marginal in [{"features": list(range(len(dimensions))), "counts": data["cube"]}] + data["marginals"]:
+            columns = [dimensions[i]["feature_name"] for i in marginal["features"]] + ["count"]
+            cells = [([], marginal["counts"])]
+            for i in marginal["features"]:
+                cells = [(index + [feature_to_text(dimensions[i]["feature_name"], q)], counts[j]) for index, counts in cells for j, q in enumerate(dimensions[i]["feature_qualifiers"])]
+            rows = [index + [count] for index, count in cells]
+            tables.append([columns, rows])
     elif "name" in data:
         columns = ["cohort_id", "name"]
         rows = [[data["cohort_id"], data["name"]]]
@@ -0,0 +1,32 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from deadline import timeouts, default_timeout
+
+# sync workers are killed when silent for longer than this, during a request or the warm-up in post_worker_init, so
+# it is kept above the largest endpoint budget and the warm-up's, letting requests end with their partial results or
+# budget error
+timeout = int(max([default_timeout, float(os.environ.get("ICEES_WARMUP_TIMEOUT", "60"))] + list(timeouts.values()))) + 30
+
+
+def when_ready(server):
+    # the default rate limit storage counts per worker, so each client gets the limit once per worker
+    if server.cfg.workers > 1 and os.environ.get("ICEES_RATELIMIT_STORAGE_URI", "memory://") == "memory://":
+        server.log.warning("rate limits are counted per worker, set ICEES_RATELIMIT_STORAGE_URI to a shared storage when running {} workers".format(server.cfg.workers))
+
+
+def post_worker_init(worker):
+    # warm the worker's caches from the request log before it accepts requests
+    if os.environ.get("ICEES_WARMUP", "false") == "true":
+        from warmup import warmup
+        warmup()
+
+
+def worker_exit(server, worker):
+    # the worker's queued and running jobs will not finish, so they are reported failed instead of waiting for the
+    # heartbeat to go stale
+    jobs = sys.modules.get("jobs")
+    if jobs is not None:
+        jobs.fail_active_jobs()
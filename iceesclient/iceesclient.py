@@ -1,21 +1,166 @@
 import requests
 import json
 import argparse
+import time
+import hashlib
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
 requests.packages.urllib3.disable_warnings()
 
 tabular_headers = {"Content-Type" : "application/json", "accept": "text/tabular"}
 json_headers = {"Content-Type" : "application/json", "accept": "application/json"}
 
+class ResponseCache():
+    """
+    On-disk cache of successful json responses, keyed by method, url (which contains the version, table and year),
+    accept header and canonical request body. Entries older than ttl seconds are revalidated with the server
+    when it sent an ETag and refetched otherwise, and the least recently used entries beyond max_entries are evicted.
+    """
+    def __init__(self, path="iceesclient_cache.sqlite", ttl=None, max_entries=10000):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS response (key TEXT PRIMARY KEY, status INTEGER, content_type TEXT, etag TEXT, body BLOB, created REAL, accessed REAL)")
+
+    def key(self, method, url, headers, data):
+        if data is not None:
+            try:
+                data = json.dumps(json.loads(data), sort_keys=True)
+            except ValueError:
+                pass
+        accept = (headers or {}).get("accept")
+        return hashlib.sha256(json.dumps([method, url, accept, data]).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self.lock, self.conn as conn:
+            row = conn.execute("SELECT status, content_type, etag, body, created FROM response WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                conn.execute("UPDATE response SET accessed = ? WHERE key = ?", (time.time(), key))
+        if row is None:
+            return None, None, False
+        status, content_type, etag, body, created = row
+        response = requests.Response()
+        response.status_code = status
+        response._content = body
+        if content_type is not None:
+            response.headers["Content-Type"] = content_type
+        if etag is not None:
+            response.headers["ETag"] = etag
+        fresh = self.ttl is None or time.time() - created < self.ttl
+        return response, etag, fresh
+
+    def put(self, key, response):
+        now = time.time()
+        with self.lock, self.conn as conn:
+            conn.execute("INSERT OR REPLACE INTO response VALUES (?, ?, ?, ?, ?, ?, ?)", (key, response.status_code, response.headers.get("Content-Type"), response.headers.get("ETag"), response.content, now, now))
+            conn.execute("DELETE FROM response WHERE key IN (SELECT key FROM response ORDER BY accessed DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def touch(self, key):
+        with self.lock, self.conn as conn:
+            conn.execute("UPDATE response SET created = ?, accessed = ? WHERE key = ?", (time.time(), time.time(), key))
+
+    def clear(self):
+        with self.lock, self.conn as conn:
+            conn.execute("DELETE FROM response")
+
+def cacheable_url(url):
+    # job status, cohort names and the cohort dictionary, which grows with each cohort defined, change under the same url
+    return "/job/" not in url and "/name/" not in url and "/cohort/dictionary" not in url
+
+
+def cacheable_response(response):
+    # errors are returned as a string "return value" with status 200, which can only be told apart in json responses,
+    # and partial results depend on the time budget
+    if response.status_code != 200 or response.headers.get("X-ICEES-Partial") is not None:
+        return False
+    if "json" not in (response.headers.get("Content-Type") or ""):
+        return False
+    try:
+        return not isinstance(response.json().get("return value"), str)
+    except ValueError:
+        return False
+
+
+class Client():
+    """
+    Sends requests over a persistent session, so connections are kept alive and reused, and retries
+    requests rejected by the server's rate limiter (429) with exponential backoff. Pass a ResponseCache
+    to answer repeated GET and POST requests from disk.
+    """
+    def __init__(self, concurrency=8, max_retries=5, backoff=0.5, verify=False, cache=None):
+        self.concurrency = concurrency
+        self.cache = cache
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.verify = verify
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def retry_delay(self, response, attempt):
+        retry_after = response.headers.get("Retry-After")
+        if retry_after is not None and retry_after.isdigit():
+            return int(retry_after)
+        return self.backoff * 2 ** attempt
+
+    def request(self, method, url, **kwargs):
+        if self.cache is None or method not in ["GET", "POST"] or not cacheable_url(url):
+            return self.send(method, url, **kwargs)
+        key = self.cache.key(method, url, kwargs.get("headers"), kwargs.get("data"))
+        cached, etag, fresh = self.cache.get(key)
+        if cached is not None and fresh:
+            return cached
+        if cached is not None and etag is not None:
+            headers = dict(kwargs.get("headers") or {})
+            headers["If-None-Match"] = etag
+            kwargs["headers"] = headers
+        response = self.send(method, url, **kwargs)
+        if response.status_code == 304 and cached is not None:
+            self.cache.touch(key)
+            return cached
+        if cacheable_response(response):
+            self.cache.put(key, response)
+        return response
+
+    def send(self, method, url, **kwargs):
+        attempt = 0
+        while True:
+            response = self.session.request(method, url, verify=self.verify, **kwargs)
+            if response.status_code != 429 or attempt >= self.max_retries:
+                return response
+            time.sleep(self.retry_delay(response, attempt))
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def batch(self, calls, concurrency=None):
+        # calls is a list of (function, args) pairs, e.g. (FeatureAssociation(client).run_feature_association, (...)),
+        # the results are returned in the same order
+        with ThreadPoolExecutor(max_workers=concurrency or self.concurrency) as executor:
+            futures = [executor.submit(function, *args) for function, args in calls]
+            return [future.result() for future in futures]
+
+default_client = Client()
+
 class DefineCohort ():
-    def __init__(self):
-        pass
+    def __init__(self, client=None):
+        self.client = client or default_client
     
     def make_cohort_definition(self, feature, value, operator):
         feature_variables = '{{"{0}": {{ "value": {1}, "operator": "{2}"}}}}'.format(feature, value, operator)
         return feature_variables
     
     def define_cohort_query(self, feature_variables, year=2010, table='patient', version='1.0.0'): # year, table, and version are hardcoded for now
-        define_cohort_response = requests.post('https://icees.renci.org/{0}/{1}/{2}/cohort'.format(version, table, year), data=feature_variables, headers = json_headers, verify = False)               
+        define_cohort_response = self.client.post('https://icees.renci.org/{0}/{1}/{2}/cohort'.format(version, table, year), data=feature_variables, headers = json_headers)               
         return define_cohort_response
 
     def run_define_cohort (self, feature, value, operator):
@@ -25,11 +170,11 @@ class DefineCohort ():
         return define_cohort_query_json
 
 class GetCohortDefinition():
-    def __init__(self):
-        pass
+    def __init__(self, client=None):
+        self.client = client or default_client
     
     def get_cohort_definition_query(self, cohort_id, year=2010, table='patient', version='1.0.0'):
-        cohort_definition_response = requests.get('https://icees.renci.org/{0}/{1}/{2}/cohort/{3}'.format(version, table, year, cohort_id), headers = json_headers, verify = False)               
+        cohort_definition_response = self.client.get('https://icees.renci.org/{0}/{1}/{2}/cohort/{3}'.format(version, table, year, cohort_id), headers = json_headers)               
         return cohort_definition_response
 
     def run_get_cohort_definition(self, cohort_id):
@@ -38,11 +183,11 @@ class GetCohortDefinition():
         return cohort_definition_query_json
     
 class GetFeatures():
-    def __init__(self):
-        pass
+    def __init__(self, client=None):
+        self.client = client or default_client
 
     def get_features_query(self, cohort_id, year=2010, table='patient', version='1.0.0'):
-        features_response = requests.get('https://icees.renci.org/{0}/{1}/{2}/cohort/{3}/features'.format(version, table, year, cohort_id), headers=json_headers, verify=False)
+        features_response = self.client.get('https://icees.renci.org/{0}/{1}/{2}/cohort/{3}/features'.format(version, table, year, cohort_id), headers=json_headers)
         return features_response
 
     def run_get_features(self, cohort_id):
@@ -51,15 +196,15 @@ class GetFeatures():
         return features_query_json
 
 class FeatureAssociation():
-    def __init__(self):
-        pass
+    def __init__(self, client=None):
+        self.client = client or default_client
 
     def make_feature_association(self, feature_a, feature_a_operator, feature_a_value, feature_b, feature_b_operator, feature_b_value):
         feature_assoc_variables = '{{"feature_a":{{"{0}":{{"operator":"{1}","value":{2}}}}},"feature_b":{{"{3}":{{"operator":"{4}","value":{5}}}}}}}'.format(feature_a, feature_a_operator, feature_a_value, feature_b, feature_b_operator, feature_b_value)
         return feature_assoc_variables
 
     def feature_association_query(self, feature_assoc_variables, cohort_id, year=2010, table='patient', version='1.0.0'):
-        feature_association_response = requests.post('https://icees.renci.org/{0}/{1}/{2}/cohort/{3}/feature_association'.format(version, table, year, cohort_id), data=feature_assoc_variables, headers=json_headers, verify=False)
+        feature_association_response = self.client.post('https://icees.renci.org/{0}/{1}/{2}/cohort/{3}/feature_association'.format(version, table, year, cohort_id), data=feature_assoc_variables, headers=json_headers)
         return feature_association_response
 
     def run_feature_association(self, feature_a, feature_a_operator, feature_a_value, feature_b, feature_b_operator, feature_b_value, cohort_id):
@@ -69,15 +214,15 @@ class FeatureAssociation():
         return feature_assoc_query_json
 
 class AssociationToAllFeatures():
-    def __init__(self):
-        pass
+    def __init__(self, client=None):
+        self.client = client or default_client
     
     def make_association_to_all_features(self, feature, value, operator, maximum_p_value):
         feature_variable_and_p_value = '{{"feature":{{"{0}":{{"operator":"{1}","value":{2}}}}},"maximum_p_value":{3}}}'.format(feature, value, operator, maximum_p_value)
         return feature_variable_and_p_value
 
     def assocation_to_all_features_query(self, feature_variable_and_p_value, cohort_id, year=2010, table='patient', version='1.0.0'):
-        assoc_to_all_features_response = requests.post('https://icees.renci.org/{0}/{1}/{2}/cohort/{3}/associations_to_all_features'.format(version, table, year, cohort_id), data=feature_variable_and_p_value, headers= json_headers, verify=False)
+        assoc_to_all_features_response = self.client.post('https://icees.renci.org/{0}/{1}/{2}/cohort/{3}/associations_to_all_features'.format(version, table, year, cohort_id), data=feature_variable_and_p_value, headers= json_headers)
         return assoc_to_all_features_response
 
     def run_association_to_all_features(self, feature, value, operator, maximum_p_value, cohort_id):
@@ -87,11 +232,11 @@ class AssociationToAllFeatures():
         return assoc_to_all_features_query_json
 
 class GetDictionary():
-    def __init__(self):
-        pass
+    def __init__(self, client=None):
+        self.client = client or default_client
 
     def get_dictionary_query(self, year=2010, table='patient', version='1.0.0'):
-        dictionary_response = requests.get('https://icees.renci.org/{0}/{1}/{2}/cohort/dictionary'.format(version, table, year), headers = json_headers, verify = False) 
+        dictionary_response = self.client.get('https://icees.renci.org/{0}/{1}/{2}/cohort/dictionary'.format(version, table, year), headers = json_headers) 
         return dictionary_response
 
     def run_get_dictionary(self):
@@ -103,14 +248,13 @@ class GetDictionary():
 # You can use the work below to treat this module as a CLI utility. Currently, it is configured to accept inputs for and
 # return values from the simplest input, "DefineCohort"... feel free to copy/fork and customize for your own purposes!
 
-parser = argparse.ArgumentParser()
-parser.add_argument("-ftr", "--feature", help="feature name")
-parser.add_argument("-v", "--value", help="feature value")
-parser.add_argument("-op", "--operator", help="feature operator")
-args = parser.parse_args()
-
 if __name__ == '__main__':
     import sys
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-ftr", "--feature", help="feature name")
+    parser.add_argument("-v", "--value", help="feature value")
+    parser.add_argument("-op", "--operator", help="feature operator")
+    args = parser.parse_args()
     if len(sys.argv) > 3:
         icees_define_cohort = DefineCohort()
         output = icees_define_cohort.run_define_cohort(args.feature, args.value, args.operator)
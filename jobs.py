@@ -0,0 +1,208 @@
+import datetime
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import Table, Column, Integer, String, DateTime, func
+from sqlalchemy.sql import select
+from model import metadata, get_db_connection, get_aggregate_connection, select_feature_association, service_name
+from features import features
+from cost import estimate_queries
+
+job_workers = int(os.environ.get(service_name + "_JOB_WORKERS", "2"))
+job_max_pending = int(os.environ.get(service_name + "_JOB_MAX_PENDING", "20"))
+job_timeout = float(os.environ.get(service_name + "_JOB_TIMEOUT", "3600"))
+job_ttl = float(os.environ.get(service_name + "_JOB_TTL", "86400"))
+# queued and running jobs whose worker has not recorded a heartbeat for job_heartbeat_interval * job_stale_heartbeats
+# seconds are reported failed
+job_heartbeat_interval = float(os.environ.get(service_name + "_JOB_HEARTBEAT_INTERVAL", "30"))
+job_stale_heartbeats = 4
+
+job = Table("job", metadata,
+            Column("job_id", String, primary_key=True),
+            Column("status", String),
+            Column("completed", Integer),
+            Column("total", Integer),
+            Column("result", String),
+            Column("created", DateTime),
+            Column("expires", DateTime, index=True),
+            Column("owner", String),
+            Column("updated", DateTime))
+
+job_tables_created = set()
+
+executor = None
+
+pending = 0
+
+pending_lock = threading.Lock()
+
+# the version of each queued or running job of this worker
+active = {}
+
+heartbeat_pid = None
+
+
+def owner():
+    return socket.gethostname() + ":" + str(os.getpid())
+
+
+def ensure_job_table(conn):
+    url = str(conn.engine.url)
+    if url not in job_tables_created:
+        metadata.create_all(conn, tables=[job], checkfirst=True)
+        # job tables created before jobs had heartbeats
+        conn.execute("ALTER TABLE job ADD COLUMN IF NOT EXISTS owner VARCHAR, ADD COLUMN IF NOT EXISTS updated TIMESTAMP WITHOUT TIME ZONE")
+        job_tables_created.add(url)
+
+
+def expires():
+    return func.now() + datetime.timedelta(seconds=job_ttl)
+
+
+def stale():
+    return job.c.updated < func.now() - datetime.timedelta(seconds=job_heartbeat_interval * job_stale_heartbeats)
+
+
+def get_job(conn, job_id):
+    ensure_job_table(conn)
+    row = conn.execute(select([job.c.status, job.c.completed, job.c.total, job.c.result, stale()]).where(job.c.job_id == job_id).where(job.c.expires > func.now())).first()
+    if row is None:
+        return None
+    status, completed, total, result, is_stale = row
+    if status in ["queued", "running"] and is_stale:
+        # the worker running the job has stopped
+        status = "failed"
+        result = "Job was lost when its worker stopped. Please submit it again."
+        conn.execute(job.update().where(job.c.job_id == job_id).where(job.c.status.in_(["queued", "running"])).values(status=status, result=result, expires=expires()))
+    ret = {
+        "job_id": job_id,
+        "status": status,
+        "completed": completed,
+        "total": total
+    }
+    if status == "done":
+        ret["result"] = json.loads(result)
+    elif status == "failed":
+        ret["error"] = result
+    return ret
+
+
+def wait_for_job(conn, job_id, wait):
+    # polls the job, which may be running in another worker, until it has finished or wait seconds have passed
+    end = time.time() + wait
+    while True:
+        ret = get_job(conn, job_id)
+        if ret is None or ret["status"] in ["done", "failed"] or time.time() >= end:
+            return ret
+        time.sleep(min(0.5, max(0, end - time.time())))
+
+
+def progress_writer(engine, job_id):
+    # writes progress at most once a second
+    last = [0]
+    def progress(completed, total):
+        if time.time() - last[0] >= 1:
+            last[0] = time.time()
+            engine.execute(job.update().where(job.c.job_id == job_id).values(completed=completed, total=total, updated=func.now()))
+    return progress
+
+
+def heartbeat():
+    # records that this worker's queued and running jobs are alive, including those counting one feature for longer
+    # than the interval
+    while True:
+        time.sleep(job_heartbeat_interval)
+        with pending_lock:
+            versions = {}
+            for job_id, version in active.items():
+                versions.setdefault(version, []).append(job_id)
+        for version, job_ids in versions.items():
+            try:
+                get_db_connection(version).execute(job.update().where(job.c.job_id.in_(job_ids)).values(updated=func.now()))
+            except Exception:
+                traceback.print_exc()
+
+
+def start_heartbeat():
+    global heartbeat_pid
+    if heartbeat_pid != os.getpid():
+        heartbeat_pid = os.getpid()
+        thread = threading.Thread(target=heartbeat)
+        thread.daemon = True
+        thread.start()
+
+
+def fail_active_jobs():
+    # called when the worker exits, its queued and running jobs will not finish
+    with pending_lock:
+        jobs = list(active.items())
+    for job_id, version in jobs:
+        try:
+            get_db_connection(version).execute(job.update().where(job.c.job_id == job_id).where(job.c.status.in_(["queued", "running"])).values(status="failed", result="Job was lost when its worker stopped. Please submit it again.", expires=expires()))
+        except Exception:
+            traceback.print_exc()
+
+
+def admit_job(admission, version, table):
+    # jobs are admitted like the synchronous endpoint, and stay queued while the server is busy
+    queries = estimate_queries("servassociationstoallfeatures", table, None)
+    return admission.acquire_waiting(queries, lambda: get_db_connection(version), job_timeout)
+
+
+def run_association_job(job_id, version, table, year, cohort_id, cohort_features, feature, maximum_p_value, sample_fraction, exact_top, admission):
+    global pending
+    engine = get_db_connection(version, job_timeout)
+    try:
+        ticket = admit_job(admission, version, table)
+        try:
+            engine.execute(job.update().where(job.c.job_id == job_id).values(status="running", updated=func.now()))
+            conn = engine.connect()
+            try:
+                aggregate_conn, aggregate_cohort_id = get_aggregate_connection(conn, version, job_timeout, cohort_id)
+                rs = select_feature_association(aggregate_conn, table, year, cohort_features, feature, maximum_p_value, aggregate_cohort_id, None, sample_fraction, exact_top, progress_writer(engine, job_id))
+            finally:
+                conn.close()
+        finally:
+            admission.release(ticket)
+        total = len(features[table])
+        engine.execute(job.update().where(job.c.job_id == job_id).values(status="done", completed=total, total=total, result=json.dumps(rs), expires=expires()))
+    except Exception as e:
+        traceback.print_exc()
+        engine.execute(job.update().where(job.c.job_id == job_id).values(status="failed", result=str(e), expires=expires()))
+    finally:
+        with pending_lock:
+            pending -= 1
+            active.pop(job_id, None)
+
+
+def submit_association_job(conn, admission, version, table, year, cohort_id, cohort_features, feature, maximum_p_value, sample_fraction=None, exact_top=0):
+    # queues the associations of feature to all features on this worker's job pool, to run under admission, and
+    # returns the job id
+    global executor, pending
+    with pending_lock:
+        if pending >= job_max_pending:
+            raise RuntimeError("Too many jobs are pending. Please try again later.")
+        pending += 1
+    job_id = None
+    try:
+        ensure_job_table(conn)
+        conn.execute(job.delete().where(job.c.expires <= func.now()))
+        job_id = "JOB:" + uuid.uuid4().hex
+        conn.execute(job.insert().values(job_id=job_id, status="queued", completed=0, total=len(features[table]), created=func.now(), expires=expires(), owner=owner(), updated=func.now()))
+        with pending_lock:
+            active[job_id] = version
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=job_workers)
+        start_heartbeat()
+        executor.submit(run_association_job, job_id, version, table, year, cohort_id, cohort_features, feature, maximum_p_value, sample_fraction, exact_top, admission)
+    except Exception:
+        with pending_lock:
+            pending -= 1
+            active.pop(job_id, None)
+        raise
+    return job_id
@@ -0,0 +1,107 @@
+import argparse
+import json
+import os
+import time
+from model import get_db_connection, tables, row_id_column, service_name, drop_materialized_cohorts
+
+default_indexes = {
+    "patient": {"btree": [["year"]]},
+    "visit": {"btree": [["year"]]}
+}
+
+indexes = json.loads(os.environ.get(service_name + "_INDEXES", json.dumps(default_indexes)))
+
+
+def quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def is_partitioned(conn, name):
+    return conn.execute("SELECT relkind = 'p' FROM pg_class WHERE relname = %s", name).scalar() == True
+
+
+def partition_name(name, year):
+    return "{0}_{1}".format(name, year)
+
+
+def default_partition_name(name):
+    return name + "_default"
+
+
+def partitions(conn, name):
+    return [r[0] for r in conn.execute("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = %s", name)]
+
+
+def create_table(conn, table_name, name, partitioned):
+    # an empty copy of the live table, partitioned by year with a partition for each year in the live table
+    if partitioned:
+        conn.execute("CREATE TABLE {0} (LIKE {1} INCLUDING DEFAULTS) PARTITION BY LIST (year)".format(quote(name), quote(table_name)))
+        for year, in conn.execute("SELECT DISTINCT year FROM {0} WHERE year IS NOT NULL".format(quote(table_name))).fetchall():
+            create_partition(conn, name, year)
+        conn.execute("CREATE TABLE {0} PARTITION OF {1} DEFAULT".format(quote(default_partition_name(name)), quote(name)))
+    else:
+        conn.execute("CREATE TABLE {0} (LIKE {1} INCLUDING DEFAULTS)".format(quote(name), quote(table_name)))
+
+
+def create_partition(conn, name, year):
+    conn.execute("CREATE TABLE {0} PARTITION OF {1} FOR VALUES IN ({2})".format(quote(partition_name(name, year)), quote(name), int(year)))
+
+
+def move_default_rows(conn, name):
+    # rows of years without a partition end up in the default partition, give those years their own partitions
+    default = default_partition_name(name)
+    years = [r[0] for r in conn.execute("SELECT DISTINCT year FROM {0} WHERE year IS NOT NULL".format(quote(default))).fetchall()]
+    if len(years) > 0:
+        conn.execute("ALTER TABLE {0} DETACH PARTITION {1}".format(quote(name), quote(default)))
+        for year in years:
+            create_partition(conn, name, year)
+            conn.execute("INSERT INTO {0} SELECT * FROM {1} WHERE year = {2}".format(quote(partition_name(name, year)), quote(default), int(year)))
+        conn.execute("DELETE FROM {0} WHERE year IS NOT NULL".format(quote(default)))
+        conn.execute("ALTER TABLE {0} ATTACH PARTITION {1} DEFAULT".format(quote(name), quote(default)))
+
+
+def create_indexes(conn, table_name, name, partitioned):
+    table = tables[table_name]
+    primary_key = [row_id_column(table).name] + (["year"] if partitioned else [])
+    conn.execute("ALTER TABLE {0} ADD PRIMARY KEY ({1})".format(quote(name), ", ".join(map(quote, primary_key))))
+    for method, columns_list in indexes.get(table_name, {}).items():
+        for columns in columns_list:
+            if partitioned and columns == ["year"]:
+                continue
+            conn.execute("CREATE INDEX ON {0} USING {1} ({2})".format(quote(name), method, ", ".join(map(quote, columns))))
+
+
+def swap(conn, table_name, name):
+    old = table_name + "_old"
+    conn.execute("ALTER TABLE {0} RENAME TO {1}".format(quote(table_name), quote(old)))
+    conn.execute("DROP TABLE {0}".format(quote(old)))
+    conn.execute("ALTER TABLE {0} RENAME TO {1}".format(quote(name), quote(table_name)))
+    for partition in partitions(conn, table_name):
+        conn.execute("ALTER TABLE {0} RENAME TO {1}".format(quote(partition), quote(table_name + partition[len(name):])))
+    drop_materialized_cohorts(conn, table_name)
+
+
+def rebuild(version, table_name, partitioned):
+    engine = get_db_connection(version)
+    name = table_name + "_layout"
+    with engine.begin() as conn:
+        # a partitioned table stays partitioned, as when it is reloaded
+        partitioned = partitioned or is_partitioned(conn, table_name)
+        conn.execute("DROP TABLE IF EXISTS {0}".format(quote(name)))
+        create_table(conn, table_name, name, partitioned)
+        conn.execute("INSERT INTO {0} SELECT * FROM {1}".format(quote(name), quote(table_name)))
+        create_indexes(conn, table_name, name, partitioned)
+        conn.execute("ANALYZE {0}".format(quote(name)))
+        swap(conn, table_name, name)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rebuild the patient or visit table with per year partitions and the indexes in " + service_name + "_INDEXES")
+    parser.add_argument("version", help="version of data, e.g. 1.0.0")
+    parser.add_argument("table", choices=list(tables.keys()), help="the table patient|visit")
+    parser.add_argument("--no-partition", action="store_true", help="do not partition an unpartitioned table by year, only rebuild its indexes")
+    args = parser.parse_args()
+
+    start = time.time()
+    rebuild(args.version, args.table, not args.no_partition)
+    print("rebuilt {0} table in {1:.1f}s".format(args.table, time.time() - start))
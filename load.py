@@ -0,0 +1,77 @@
+import argparse
+import csv
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+from model import get_db_connection, tables
+from layout import quote, is_partitioned, create_table, move_default_rows, create_indexes, swap
+
+
+def copy_file(engine, staging, filename):
+    start = time.time()
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        rows = 0
+        if filename.endswith(".parquet"):
+            for header, f in parquet_chunks(filename):
+                cursor.copy_expert("COPY {0} ({1}) FROM STDIN WITH (FORMAT csv)".format(quote(staging), ", ".join(map(quote, header))), f)
+                rows += cursor.rowcount
+        else:
+            with open(filename, newline="") as f:
+                header = next(csv.reader([f.readline()]))
+                f.seek(0)
+                cursor.copy_expert("COPY {0} ({1}) FROM STDIN WITH (FORMAT csv, HEADER true)".format(quote(staging), ", ".join(map(quote, header))), f)
+                rows += cursor.rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    return filename, rows, time.time() - start
+
+
+def parquet_chunks(filename):
+    import pyarrow.parquet as pq
+    f = pq.ParquetFile(filename)
+    for i in range(f.num_row_groups):
+        df = f.read_row_group(i).to_pandas()
+        yield list(df.columns), io.StringIO(df.to_csv(index=False, header=False))
+
+
+def load(version, table_name, files, workers, replace_all=False, partition=False):
+    engine = get_db_connection(version)
+    staging = table_name + "_load"
+
+    with engine.begin() as conn:
+        partitioned = partition or is_partitioned(conn, table_name)
+        conn.execute("DROP TABLE IF EXISTS {0}".format(quote(staging)))
+        create_table(conn, table_name, staging, partitioned)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for filename, rows, seconds in executor.map(lambda filename: copy_file(engine, staging, filename), files):
+            print("loaded {0} rows from {1} in {2:.1f}s".format(rows, filename, seconds))
+
+    with engine.begin() as conn:
+        if not replace_all:
+            conn.execute("INSERT INTO {0} SELECT * FROM {1} WHERE year NOT IN (SELECT DISTINCT year FROM {0})".format(quote(staging), quote(table_name)))
+        if partitioned:
+            move_default_rows(conn, staging)
+        create_indexes(conn, table_name, staging, partitioned)
+        conn.execute("ANALYZE {0}".format(quote(staging)))
+
+    with engine.begin() as conn:
+        swap(conn, table_name, staging)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load preprocessed files into the patient or visit table")
+    parser.add_argument("version", help="version of data, e.g. 1.0.0")
+    parser.add_argument("table", choices=list(tables.keys()), help="the table patient|visit")
+    parser.add_argument("files", nargs="+", help="preprocessed csv or parquet files, e.g. one per year")
+    parser.add_argument("--workers", type=int, default=4, help="number of files loaded in parallel")
+    parser.add_argument("--replace-all", action="store_true", help="drop rows of years not present in the input files")
+    parser.add_argument("--partition", action="store_true", help="partition the table by year, tables that are already partitioned stay partitioned")
+    args = parser.parse_args()
+
+    start = time.time()
+    load(args.version, args.table, args.files, args.workers, args.replace_all, args.partition)
+    print("swapped in new {0} table in {1:.1f}s".format(args.table, time.time() - start))
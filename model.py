@@ -1,17 +1,34 @@
-from sqlalchemy import Table, Column, Integer, String, MetaData, create_engine, func, Sequence, between
-from sqlalchemy.sql import select
-from scipy.stats import chisquare
+from sqlalchemy import Table, Column, Integer, String, DateTime, MetaData, create_engine, func, Sequence, between, literal, tablesample, and_, case, tuple_, literal_column, event
+from sqlalchemy.sql import select, bindparam, text
+from sqlalchemy.util import LRUCache
+from sqlalchemy.dialects.postgresql import insert
 import json
 import os
+import time
+import itertools
+import math
+import traceback
+import threading
+from contextlib import contextmanager
+import numpy as np
 from features import features, lookUpFeatureClass
+from stats import chi_squared
+from cache import ResultCache
+from diagnostics import instrument
 
 service_name = "ICEES"
 
-serv_user = os.environ[service_name + "_DBUSER"]
-serv_password = os.environ[service_name + "_DBPASS"]
-serv_host = os.environ[service_name + "_HOST"]
-serv_port = os.environ[service_name + "_PORT"]
-serv_database = json.loads(os.environ[service_name + "_DATABASE"])
+replica_hosts = json.loads(os.environ.get(service_name + "_REPLICA_HOSTS", "[]"))
+replica_health_interval = float(os.environ.get(service_name + "_REPLICA_HEALTH_INTERVAL", "10"))
+
+sample_seed = int(os.environ.get(service_name + "_SAMPLE_SEED", "0"))
+
+materialize_cohorts = os.environ.get(service_name + "_MATERIALIZE_COHORTS", "false") == "true"
+materialize_max_size = int(os.environ.get(service_name + "_MATERIALIZE_MAX_SIZE", "1000000"))
+materialize_max_cohorts = int(os.environ.get(service_name + "_MATERIALIZE_MAX_COHORTS", "100"))
+materialize_max_rows = int(os.environ.get(service_name + "_MATERIALIZE_MAX_ROWS", "10000000"))
+
+cube_max_cells = int(os.environ.get(service_name + "_CUBE_MAX_CELLS", "100000"))
 
 
 metadata = MetaData()
@@ -39,22 +56,288 @@ cohort = Table("cohort", metadata, *cohort_cols)
 
 cohort_id_seq = Sequence('cohort_id_seq', metadata=metadata)
 
-def get_db_connection(version):
-    engine = create_engine("postgresql+psycopg2://"+serv_user+":"+serv_password+"@"+serv_host+":"+serv_port+"/"+serv_database[version])
-    return engine
+cohort_member = Table("cohort_member", metadata, Column("cohort_id", String, index=True), Column("row_id", String), prefixes=["UNLOGGED"])
+
+# the registry is unlogged like the members, so that a crash or failover, which empties unlogged tables, empties both
+cohort_materialized = Table("cohort_materialized", metadata, Column("cohort_id", String, primary_key=True), Column("table", String), Column("size", Integer), Column("last_used", DateTime), prefixes=["UNLOGGED"])
+
+materialization_tables_created = set()
+
+engines = {}
+
+engines_pid = None
+
+statement_deadlines = threading.local()
+
+
+@contextmanager
+def deadline_statements(deadline):
+    # caps the statement timeout of each query this thread issues in the block at the time left in deadline
+    previous = getattr(statement_deadlines, "deadline", None)
+    statement_deadlines.deadline = deadline
+    try:
+        yield
+    finally:
+        statement_deadlines.deadline = previous
+
+
+def limit_statement_timeout(conn, cursor, statement, parameters, context, executemany):
+    deadline = getattr(statement_deadlines, "deadline", None)
+    if deadline is not None and deadline.end is not None:
+        # local to the transaction, so the engine's timeout applies again once the connection is returned to the pool
+        cursor.execute("SET LOCAL statement_timeout = " + str(max(1, int(deadline.remaining() * 1000))))
+
+
+def get_db_connection(version, timeout=None, host=None, port=None):
+    # one engine, and so one connection pool, per version, statement timeout in seconds and host. Engines are
+    # created on first use in each process, so a preloaded app never shares pooled connections across a fork
+    global engines_pid
+    if engines_pid != os.getpid():
+        engines.clear()
+        engines_pid = os.getpid()
+    host = host or os.environ[service_name + "_HOST"]
+    port = port or os.environ[service_name + "_PORT"]
+    key = (version, timeout, host, port)
+    if key not in engines:
+        serv_user = os.environ[service_name + "_DBUSER"]
+        serv_password = os.environ[service_name + "_DBPASS"]
+        serv_database = json.loads(os.environ[service_name + "_DATABASE"])
+        connect_args = {"connect_timeout": 10}
+        if timeout is not None:
+            connect_args["options"] = "-c statement_timeout=" + str(int(timeout * 1000))
+        engine = instrument(create_engine("postgresql+psycopg2://"+serv_user+":"+serv_password+"@"+host+":"+port+"/"+serv_database[version], connect_args=connect_args))
+        event.listen(engine, "before_cursor_execute", limit_statement_timeout)
+        engines[key] = engine
+    return engines[key]
+
+
+replica_health = {}
+
+replica_counter = itertools.count()
+
+def replica_healthy(engine, replica):
+    healthy, checked = replica_health.get(replica, (True, 0))
+    if time.time() - checked > replica_health_interval:
+        try:
+            with engine.connect() as conn:
+                conn.execute(select([literal(1)])).scalar()
+            healthy = True
+        except Exception:
+            healthy = False
+        replica_health[replica] = (healthy, time.time())
+    return healthy
+
+
+def get_read_connection(version, timeout=None):
+    # round robin over the healthy read replicas, falling back to the primary
+    n = len(replica_hosts)
+    start = next(replica_counter)
+    for i in range(n):
+        replica = replica_hosts[(start + i) % n]
+        host, _, port = replica.partition(":")
+        engine = get_db_connection(version, timeout, host, port or None)
+        if replica_healthy(engine, replica):
+            return engine
+    return get_db_connection(version, timeout)
+
+
+def get_aggregate_connection(conn, version, timeout, cohort_id):
+    # materialized cohorts are in unlogged tables, which are not replicated, so they are aggregated on the primary
+    if is_cohort_materialized(conn, cohort_id):
+        return conn, cohort_id
+    else:
+        return get_read_connection(version, timeout), None
+
+
+operators = {
+    ">": lambda column, v: column > v["value"],
+    "<": lambda column, v: column < v["value"],
+    ">=": lambda column, v: column >= v["value"],
+    "<=": lambda column, v: column <= v["value"],
+    "=": lambda column, v: column == v["value"],
+    "<>": lambda column, v: column != v["value"],
+    "between": lambda column, v: between(column, v["value_a"], v["value_b"]),
+    "in": lambda column, v: column.in_(v["values"])
+}
+
+
+def filter_condition(table, k, v):
+    return operators[v["operator"]](table.c[k], v)
 
 
 def filter_select(s, table, k, v):
-    return {
-        ">": lambda: s.where(table.c[k] > v["value"]),
-        "<": lambda: s.where(table.c[k] < v["value"]),
-        ">=": lambda: s.where(table.c[k] >= v["value"]),
-        "<=": lambda: s.where(table.c[k] <= v["value"]),
-        "=": lambda: s.where(table.c[k] == v["value"]),
-        "<>": lambda: s.where(table.c[k] != v["value"]),
-        "between": lambda: s.where(between(table.c[k], v["value_a"], v["value_b"])),
-        "in": lambda: s.where(table.c[k].in_(v["values"]))
-    }[v["operator"]]()
+    return s.where(filter_condition(table, k, v))
+
+
+def row_id_column(table):
+    return list(table.primary_key.columns)[0]
+
+
+def ensure_materialization_tables(conn):
+    url = str(conn.engine.url)
+    if url not in materialization_tables_created:
+        metadata.create_all(conn, tables=[cohort_member, cohort_materialized], checkfirst=True)
+        # registries created before it was unlogged
+        persistence = conn.execute(text("SELECT relpersistence FROM pg_class WHERE oid = to_regclass(:name)"), name=cohort_materialized.name).scalar()
+        if persistence != "u":
+            conn.execute("ALTER TABLE " + cohort_materialized.name + " SET UNLOGGED")
+        materialization_tables_created.add(url)
+
+
+def materialize_cohort(conn, table_name, year, cohort_features, cohort_id, size):
+    if not materialize_cohorts or size > materialize_max_size:
+        return False
+    ensure_materialization_tables(conn)
+    table = tables[table_name]
+    s = select([literal(cohort_id), row_id_column(table)]).where(table.c.year == year)
+    for k, v in cohort_features.items():
+        s = filter_select(s, table, k, v)
+    # members and registration are written together so that a failure leaves no orphaned rows
+    with conn.engine.begin() as tx:
+        tx.execute(cohort_member.delete().where(cohort_member.c.cohort_id == cohort_id))
+        tx.execute(cohort_member.insert().from_select(["cohort_id", "row_id"], s))
+        tx.execute(cohort_materialized.insert().values(cohort_id=cohort_id, table=table_name, size=size, last_used=func.now()))
+    evict_materialized_cohorts(conn)
+    return True
+
+
+def evict_materialized_cohorts(conn):
+    s = select([cohort_materialized.c.cohort_id, cohort_materialized.c.size]).order_by(cohort_materialized.c.last_used.desc())
+    n = 0
+    rows = 0
+    for cohort_id, size in conn.execute(s).fetchall():
+        n += 1
+        rows += size
+        if n > materialize_max_cohorts or rows > materialize_max_rows:
+            conn.execute(cohort_materialized.delete().where(cohort_materialized.c.cohort_id == cohort_id))
+            conn.execute(cohort_member.delete().where(cohort_member.c.cohort_id == cohort_id))
+
+
+def drop_materialized_cohorts(conn, table_name):
+    # called by load.py and layout.py, which usually run without the api's environment, so the members are dropped
+    # whenever the tables exist, whether or not materialization is enabled here
+    if conn.execute(text("SELECT to_regclass(:name)"), name=cohort_materialized.name).scalar() is None:
+        return
+    s = select([cohort_materialized.c.cohort_id]).where(cohort_materialized.c.table == table_name)
+    for cohort_id, in conn.execute(s).fetchall():
+        conn.execute(cohort_materialized.delete().where(cohort_materialized.c.cohort_id == cohort_id))
+        conn.execute(cohort_member.delete().where(cohort_member.c.cohort_id == cohort_id))
+
+
+def is_cohort_materialized(conn, cohort_id):
+    if not materialize_cohorts or cohort_id is None:
+        return False
+    ensure_materialization_tables(conn)
+    u = cohort_materialized.update().where(cohort_materialized.c.cohort_id == cohort_id).values(last_used=func.now())
+    return conn.execute(u).rowcount > 0
+
+
+def qualifier_placeholders(v, name):
+    # the qualifier with bind parameters, named after name, in place of its values
+    operator = v["operator"]
+    if operator == "between":
+        return {"operator": operator, "value_a": bindparam(name + "_a"), "value_b": bindparam(name + "_b")}
+    elif operator == "in":
+        return {"operator": operator, "values": [bindparam(name + "_" + str(i)) for i in range(len(v["values"]))]}
+    else:
+        return {"operator": operator, "value": bindparam(name)}
+
+
+def qualifier_parameters(v, name):
+    operator = v["operator"]
+    if operator == "between":
+        return {name + "_a": v["value_a"], name + "_b": v["value_b"]}
+    elif operator == "in":
+        return {name + "_" + str(i): value for i, value in enumerate(v["values"])}
+    else:
+        return {name: v["value"]}
+
+
+def qualifier_shape(k, v):
+    return k, v["operator"], len(v["values"]) if v["operator"] == "in" else 1
+
+
+def count_source(source, table_name):
+    # the table whose columns are filtered and the from clause of a count
+    table = tables[table_name]
+    if source == "table":
+        return table, table
+    elif source == "members":
+        return table, table.join(cohort_member, (cohort_member.c.row_id == row_id_column(table)) & (cohort_member.c.cohort_id == bindparam("cohort_id")))
+    elif source == "sample":
+        sample = tablesample(table, func.system(bindparam("sample_percent")), seed=bindparam("sample_seed"))
+        return sample, sample
+
+
+# count statements by shape, and their compiled forms
+count_statements = LRUCache(int(os.environ.get(service_name + "_STATEMENT_CACHE_SIZE", "1000")))
+
+compiled_cache = LRUCache(int(os.environ.get(service_name + "_STATEMENT_CACHE_SIZE", "1000")))
+
+
+class CountQuery():
+    """
+    A count of the rows of a table, its members of a materialized cohort or a sample of it, in a year, that meet a
+    list of qualifiers. Counts of the same shape, the source, the columns and operators of the qualifiers in order
+    and the lengths of in lists, share a statement with bind parameters, which is compiled once.
+    """
+
+    def __init__(self, source, table_name, parameters, qualifiers=()):
+        self.source = source
+        self.table_name = table_name
+        self.parameters = parameters
+        self.qualifiers = qualifiers
+
+    def where(self, k, v):
+        return CountQuery(self.source, self.table_name, self.parameters, self.qualifiers + ((k, v),))
+
+    def shape(self):
+        return (self.source, self.table_name) + tuple(qualifier_shape(k, v) for k, v in self.qualifiers)
+
+    def statement(self):
+        shape = self.shape()
+        s = count_statements.get(shape)
+        if s is None:
+            table, source = count_source(self.source, self.table_name)
+            s = select([func.count()]).select_from(source).where(table.c.year == bindparam("year"))
+            for i, (k, v) in enumerate(self.qualifiers):
+                s = s.where(filter_condition(table, k, qualifier_placeholders(v, "q" + str(i))))
+            count_statements[shape] = s
+        return s
+
+    def bound_parameters(self):
+        parameters = dict(self.parameters)
+        for i, (k, v) in enumerate(self.qualifiers):
+            parameters.update(qualifier_parameters(v, "q" + str(i)))
+        return parameters
+
+    def select(self):
+        # the statement with the values bound, to be used in other statements
+        return self.statement().params(self.bound_parameters())
+
+    def count(self, conn):
+        return conn.execution_options(compiled_cache=compiled_cache).execute(self.statement(), self.bound_parameters()).scalar()
+
+
+def cohort_select(conn, table_name, year, cohort_features, cohort_id=None):
+    # cohort_id is only given for cohorts that get_aggregate_connection found to be materialized
+    if cohort_id is not None:
+        return CountQuery("members", table_name, {"year": year, "cohort_id": cohort_id})
+    else:
+        s = CountQuery("table", table_name, {"year": year})
+        for k, v in cohort_features.items():
+            s = s.where(k, v)
+        return s
+
+
+def sample_select(table_name, year, cohort_features, sample_fraction):
+    # a count over a sample of about sample_fraction of the table's blocks, the same sample for every query
+    if sample_fraction <= 0 or sample_fraction > 1:
+        raise RuntimeError("sample_fraction must be greater than 0 and at most 1")
+    s = CountQuery("sample", table_name, {"year": year, "sample_percent": sample_fraction * 100, "sample_seed": sample_seed})
+    for k, v in cohort_features.items():
+        s = s.where(k, v)
+    return s
 
 
 def opposite(qualifier):
@@ -71,6 +354,14 @@ def opposite(qualifier):
     }
 
 
+def to_qualifiers(feature):
+    k, v = list(feature.items())[0]
+    return {
+        "feature_name": k,
+        "feature_qualifiers": [v, opposite(v)]
+    }
+
+
 def select_cohort(conn, table_name, year, cohort_features, cohort_id=None):
     table = tables[table_name]
     s = select([func.count()]).select_from(table).where(table.c.year == year)
@@ -100,6 +391,11 @@ def select_cohort(conn, table_name, year, cohort_features, cohort_id=None):
                                          year=year)
 
         conn.execute(ins)
+        try:
+            materialize_cohort(conn, table_name, year, cohort_features, cohort_id, size)
+        except Exception:
+            # the cohort has been created; without members its counts fall back to the feature filters
+            traceback.print_exc()
         return cohort_id, size
 
 
@@ -135,19 +431,43 @@ def get_cohort_by_id(conn, table_name, year, cohort_id):
         }
 
 
-def get_cohort_features(conn, table_name, year, cohort_features):
+def deadline_passed(deadline):
+    # whether a failed statement was cancelled by a statement timeout capped at the deadline. A partial request then
+    # keeps the results so far, any other raises the deadline's error instead of the database's
+    return deadline is not None and deadline.end is not None and deadline.remaining() <= 0 and not deadline.check()
+
+
+def get_cohort_features(conn, table_name, year, cohort_features, cohort_id=None, deadline=None):
     table = tables[table_name]
+    s = cohort_select(conn, table_name, year, cohort_features, cohort_id)
     rs = []
     for k, v, levels, _ in features[table_name]:
-        if levels is None:
-            levels = get_feature_levels(conn, table, year, k)
-        ret = select_feature_count(conn, table_name, year, cohort_features, {"feature_name": k, "feature_qualifiers": list(map(lambda level: {"operator": "=", "value": level}, levels))})
+        if deadline is not None and not deadline.check():
+            break
+        try:
+            if levels is None:
+                levels = get_feature_levels(conn, table, year, k)
+            ret = feature_count(conn, table_name, s, {"feature_name": k, "feature_qualifiers": list(map(lambda level: {"operator": "=", "value": level}, levels))})
+        except Exception:
+            if deadline_passed(deadline):
+                break
+            raise
         rs.append(ret)
     return rs
 
 
-def get_cohort_dictionary(conn, table_name, year):
-    s = select([cohort.c.cohort_id,cohort.c.features,cohort.c.size]).where(cohort.c.table == table_name).where(cohort.c.year == year)
+def cohort_dictionary_select(table_name, year, after=None):
+    # ordered by cohort id, so that a page starts after the last cohort id of the previous page
+    s = select([cohort.c.cohort_id,cohort.c.features,cohort.c.size]).where(cohort.c.table == table_name).where(cohort.c.year == year).order_by(cohort.c.cohort_id)
+    if after is not None:
+        s = s.where(cohort.c.cohort_id > after)
+    return s
+
+
+def get_cohort_dictionary(conn, table_name, year, limit=None, after=None):
+    s = cohort_dictionary_select(table_name, year, after)
+    if limit is not None:
+        s = s.limit(limit)
     rs = []
     for cohort_id, features, size in conn.execute(s):
         rs.append({
@@ -158,12 +478,20 @@ def get_cohort_dictionary(conn, table_name, year):
     return rs
 
 
-def cohort_id_in_use(conn, cohort_id):
-    return conn.execute(select([func.count()]).select_from(cohort).where(cohort.c.cohort_id == cohort_id)).scalar() > 0
+def stream_cohort_dictionary(conn, table_name, year, after=None, batch_size=1000):
+    # yields each entry as json, fetching batch_size rows at a time from a server side cursor, with the features
+    # written out as stored
+    result = conn.execution_options(stream_results=True).execute(cohort_dictionary_select(table_name, year, after))
+    while True:
+        rows = result.fetchmany(batch_size)
+        if len(rows) == 0:
+            break
+        for cohort_id, features, size in rows:
+            yield '{"cohort_id": ' + json.dumps(cohort_id) + ', "size": ' + json.dumps(size) + ', "features": ' + features + '}'
 
 
-def join_lists(lists):
-    return [x for l in lists for x in l]
+def cohort_id_in_use(conn, cohort_id):
+    return conn.execute(select([func.count()]).select_from(cohort).where(cohort.c.cohort_id == cohort_id)).scalar() > 0
 
 
 def div(a,b):
@@ -173,29 +501,39 @@ def div(a,b):
         return float("NaN")
 
 
-def select_feature_matrix(conn, table_name, year, cohort_features, feature_a, feature_b):
-    table = tables[table_name]
-    s = select([func.count()]).select_from(table).where(table.c.year == year)
-    for k, v in cohort_features.items():
-        s = filter_select(s, table, k, v)
+def select_feature_matrix(conn, table_name, year, cohort_features, feature_a, feature_b, cohort_id=None):
+    s = cohort_select(conn, table_name, year, cohort_features, cohort_id)
+    return feature_matrix(conn, table_name, s, feature_a, feature_b)
+
+
+def feature_matrix(conn, table_name, s, feature_a, feature_b):
+    counts = feature_matrix_counts(conn, table_name, s, feature_a, feature_b)
+    [chi_squared_value], [p] = chi_squared(*zip(*[counts]))
+    return feature_matrix_result(table_name, feature_a, feature_b, counts, chi_squared_value, p)
 
+
+def feature_matrix_counts(conn, table_name, s, feature_a, feature_b):
     ka = feature_a["feature_name"]
     vas = feature_a["feature_qualifiers"]
     kb = feature_b["feature_name"]
     vbs = feature_b["feature_qualifiers"]
 
     feature_matrix = [
-        [conn.execute(filter_select(filter_select(s, table, kb, vb), table, ka, va)).scalar() for va in vas] for vb in vbs
+        [s.where(kb, vb).where(ka, va).count(conn) for va in vas] for vb in vbs
     ]
 
-    total_cols = [conn.execute(filter_select(s, table, ka, va)).scalar() for va in vas]
-    total_rows = [conn.execute(filter_select(s, table, kb, vb)).scalar() for vb in vbs]
+    total_cols = [s.where(ka, va).count(conn) for va in vas]
+    total_rows = [s.where(kb, vb).count(conn) for vb in vbs]
+
+    total = s.count(conn)
 
-    total = conn.execute(s).scalar()
+    return feature_matrix, total_rows, total_cols, total
 
-    null_matrix = [[div(r * c, total) for c in total_cols] for r in total_rows]
 
-    [chi_squared, p] = chisquare(join_lists(feature_matrix), join_lists(null_matrix))
+def feature_matrix_result(table_name, feature_a, feature_b, counts, chi_squared_value, p):
+    feature_matrix, total_rows, total_cols, total = counts
+    ka = feature_a["feature_name"]
+    kb = feature_b["feature_name"]
 
     feature_matrix2 = [
         [
@@ -221,26 +559,58 @@ def select_feature_matrix(conn, table_name, year, cohort_features, feature_a, fe
         "columns": [{"frequency": a, "percentage": b} for (a,b) in zip(total_cols, map(lambda x: x/total, total_cols))],
         "total": total,
         "p_value": p,
-        "chi_squared": chi_squared
+        "chi_squared": chi_squared_value
     }
 
 
-def select_feature_count(conn, table_name, year, cohort_features, feature_a):
-    table = tables[table_name]
-    s = select([func.count()]).select_from(table).where(table.c.year == year)
-    for k, v in cohort_features.items():
-        s = filter_select(s, table, k, v)
+def error_bound(n, sample_fraction):
+    # half width of the 95% interval of a scaled count, treating the sample as rows drawn independently
+    return 1.96 * math.sqrt(n * (1 - sample_fraction)) / sample_fraction
+
+
+def scale_counts(counts, sample_fraction):
+    feature_matrix, total_rows, total_cols, total = counts
+    return (
+        [[cell / sample_fraction for cell in row] for row in feature_matrix],
+        [n / sample_fraction for n in total_rows],
+        [n / sample_fraction for n in total_cols],
+        total / sample_fraction
+    )
 
+
+def approximate_result(table_name, feature_a, feature_b, counts, chi_squared_value, p, sample_fraction):
+    # frequencies are scaled from the sample counts, while the p value is that of the sample counts
+    result = feature_matrix_result(table_name, feature_a, feature_b, scale_counts(counts, sample_fraction), chi_squared_value, p)
+    feature_matrix, total_rows, total_cols, total = counts
+    for row, cells in zip(result["feature_matrix"], feature_matrix):
+        for cell, n in zip(row, cells):
+            cell["frequency_error"] = error_bound(n, sample_fraction)
+    for row, n in zip(result["rows"], total_rows):
+        row["frequency_error"] = error_bound(n, sample_fraction)
+    for column, n in zip(result["columns"], total_cols):
+        column["frequency_error"] = error_bound(n, sample_fraction)
+    result["total_error"] = error_bound(total, sample_fraction)
+    result["sample_fraction"] = sample_fraction
+    return result
+
+
+def select_feature_count(conn, table_name, year, cohort_features, feature_a, cohort_id=None):
+    s = cohort_select(conn, table_name, year, cohort_features, cohort_id)
+    return feature_count(conn, table_name, s, feature_a)
+
+
+def feature_count(conn, table_name, s, feature_a):
     ka = feature_a["feature_name"]
     vas = feature_a["feature_qualifiers"]
 
-    print(ka)
-    print(s)
-
-    feature_matrix = [conn.execute(filter_select(s, table, ka, va)).scalar() for va in vas]
+    feature_matrix = [s.where(ka, va).count(conn) for va in vas]
     
-    total = conn.execute(s).scalar()
+    total = s.count(conn)
+
+    return feature_count_result(feature_a, feature_matrix, total)
+
 
+def feature_count_result(feature_a, feature_matrix, total):
     feature_percentage = map(lambda x: x/total, feature_matrix)
 
     return {
@@ -249,22 +619,211 @@ def select_feature_count(conn, table_name, year, cohort_features, feature_a):
     }
 
 
+# levels of the features whose levels are only known from the data
+feature_levels = ResultCache(int(os.environ.get(service_name + "_FEATURE_LEVELS_MAX_ENTRIES", "10000")), float(os.environ.get(service_name + "_FEATURE_LEVELS_TTL", "3600")))
+
+
 def get_feature_levels(conn, table, year, feature):
-    s = select([table.c[feature]]).where(table.c.year == year).distinct().order_by(table.c[feature])
+    key = (str(conn.engine.url), table.name, year, feature)
+    levels = feature_levels.get(key)
+    if levels is None:
+        s = select([table.c[feature]]).where(table.c.year == year).distinct().order_by(table.c[feature])
+        levels = list(map(lambda row: row[0], conn.execute(s)))
+        feature_levels.put(key, levels)
+    return levels
+
+
+def select_feature_association(conn, table_name, year, cohort_features, feature, maximum_p_value, cohort_id=None, deadline=None, sample_fraction=None, exact_top=0, progress=None):
+    # with sample_fraction, the tables are counted on a sample of the table, the results are sorted by p value and
+    # the first exact_top are counted again on the whole table. progress is called with the number of features
+    # counted and the number of features
+    table = tables[table_name]
+    if sample_fraction is None:
+        s = cohort_select(conn, table_name, year, cohort_features, cohort_id)
+    else:
+        s = sample_select(table_name, year, cohort_features, sample_fraction)
+    feature_bs = []
+    counts = []
+    for k, v, levels, _ in features[table_name]:
+        if deadline is not None and not deadline.check():
+            break
+        try:
+            if levels is None:
+                levels = get_feature_levels(conn, table, year, k)
+            feature_b = {"feature_name": k, "feature_qualifiers": list(map(lambda level: {"operator": "=", "value": level}, levels))}
+            c = feature_matrix_counts(conn, table_name, s, feature, feature_b)
+        except Exception:
+            if deadline_passed(deadline):
+                break
+            raise
+        feature_bs.append(feature_b)
+        counts.append(c)
+        if progress is not None:
+            progress(len(counts), len(features[table_name]))
+    if len(counts) == 0:
+        return []
+    chi_squared_values, ps = chi_squared(*zip(*counts))
+    rs = []
+    for feature_b, c, chi_squared_value, p in zip(feature_bs, counts, chi_squared_values, ps):
+        if p < maximum_p_value:
+            if sample_fraction is None:
+                rs.append(feature_matrix_result(table_name, feature, feature_b, c, chi_squared_value, p))
+            else:
+                rs.append(approximate_result(table_name, feature, feature_b, c, chi_squared_value, p, sample_fraction))
+    if sample_fraction is not None:
+        rs.sort(key=lambda r: r["p_value"])
+        s = cohort_select(conn, table_name, year, cohort_features, cohort_id)
+        for i in range(min(exact_top, len(rs))):
+            if deadline is not None and not deadline.check():
+                break
+            try:
+                rs[i] = feature_matrix(conn, table_name, s, feature, rs[i]["feature_b"])
+            except Exception:
+                if deadline_passed(deadline):
+                    break
+                raise
+    return rs
+
+def bin_column(table, feature, name):
+    # the index of the first qualifier a row meets, null if it meets none
+    return case([(filter_condition(table, feature["feature_name"], v), i) for i, v in enumerate(feature["feature_qualifiers"])]).label(name)
+
+
+def select_feature_cube(conn, table_name, year, cohort_features, feature_list, marginals=None, cohort_id=None):
+    # the counts of the cohort for every combination of the features' bins, and the counts over the features in each
+    # marginal, a list of feature indices, computed in one scan with grouping sets. A row is counted in the first bin
+    # of a feature it meets, and not counted in a combination if it meets no bin of one of its features
+    table = tables[table_name]
+    n = len(feature_list)
+    if marginals is None:
+        marginals = [[i] for i in range(n)]
+    for marginal in marginals:
+        if any(i < 0 or i >= n for i in marginal):
+            raise RuntimeError("Marginal " + str(marginal) + " out of range. Please try again.")
+    marginals = [sorted(set(marginal)) for marginal in marginals]
+    grouping_sets = [list(range(n))] + [marginal for marginal in marginals if len(marginal) < n and len(marginal) > 0]
+
+    shapes = [len(feature["feature_qualifiers"]) for feature in feature_list]
+    cells = sum(int(np.prod([shapes[i] for i in grouping_set])) for grouping_set in grouping_sets)
+    if cells > cube_max_cells:
+        raise RuntimeError("Feature cube has " + str(cells) + " cells, more than " + str(cube_max_cells) + ". Please try again with fewer features or bins.")
+
+    s = cohort_select(conn, table_name, year, cohort_features, cohort_id)
+    bins = s.select().with_only_columns([bin_column(table, feature, "bin_" + str(i)) for i, feature in enumerate(feature_list)]).alias()
+    columns = [bins.c["bin_" + str(i)] for i in range(n)]
+    grouping_sets_expr = [tuple_(*[columns[i] for i in grouping_set]) for grouping_set in grouping_sets] + [literal_column("()")]
+    cube_select = select(columns + [func.grouping(*columns), func.count()]).group_by(func.grouping_sets(*grouping_sets_expr))
+
+    # the grouping of a set has the bit of each column not in the set set, the first column being the highest bit
+    def grouping(indices):
+        return sum(1 << (n - 1 - i) for i in range(n) if i not in indices)
+
+    arrays = {grouping(grouping_set): np.zeros([shapes[i] for i in grouping_set], dtype=np.int64) for grouping_set in grouping_sets}
+    total = 0
+    for row in conn.execute(cube_select):
+        g, count = row[n], row[n + 1]
+        if g == grouping([]):
+            total = count
+        elif g in arrays:
+            index = tuple(b for i, b in enumerate(row[:n]) if not g & (1 << (n - 1 - i)))
+            if None not in index:
+                arrays[g][index] = count
+
+    feature_list = [feature.copy() for feature in feature_list]
+    for feature in feature_list:
+        feature["biolink_class"] = lookUpFeatureClass(table_name, feature["feature_name"])
+
+    return {
+        "dimensions": feature_list,
+        "cube": arrays[grouping(range(n))].tolist(),
+        "marginals": [{"features": marginal, "counts": arrays[grouping(marginal)].tolist() if len(marginal) > 0 else total} for marginal in marginals],
+        "total": total
+    }
+
+
+# postgres allows at most 1664 columns in a select list
+max_aggregates = 1000
+
+
+def grouped_counts(conn, table, years, cohort_features, conditions):
+    # the size of the cohort and the number of its rows meeting each condition, for each year, grouped by year so that
+    # each chunk of max_aggregates conditions is counted in one scan
+    s = select([table.c.year, func.count()]).select_from(table).where(table.c.year.in_(years))
+    for k, v in cohort_features.items():
+        s = filter_select(s, table, k, v)
+    s = s.group_by(table.c.year)
+    counts = {year: [0] * (len(conditions) + 1) for year in years}
+    for offset in range(0, max(len(conditions), 1), max_aggregates):
+        chunk = conditions[offset:offset + max_aggregates]
+        for row in conn.execute(s.with_only_columns([table.c.year, func.count()] + [func.count().filter(condition) for condition in chunk])):
+            year = row[0]
+            counts[year][0] = row[1]
+            counts[year][offset + 1:offset + 1 + len(chunk)] = row[2:]
+    return counts
+
+
+def get_feature_levels_by_years(conn, table, years, feature):
+    s = select([table.c[feature]]).where(table.c.year.in_(years)).distinct().order_by(table.c[feature])
     return list(map(lambda row: row[0], conn.execute(s)))
 
 
-def select_feature_association(conn, table_name, year, cohort_features, feature, maximum_p_value):
+def get_cohort_features_by_year(conn, table_name, years, cohort_features):
+    # the size and feature profile of the cohort in each year, None for years where the cohort has 10 or fewer patients
     table = tables[table_name]
-    rs = []
+    feature_as = []
     for k, v, levels, _ in features[table_name]:
         if levels is None:
-            levels = get_feature_levels(conn, table, year, k)
-        ret = select_feature_matrix(conn, table_name, year, cohort_features, feature, {"feature_name": k, "feature_qualifiers": list(map(lambda level: {"operator": "=", "value": level}, levels))})
-        if ret["p_value"] < maximum_p_value:
-            rs.append(ret)
+            levels = get_feature_levels_by_years(conn, table, years, k)
+        feature_as.append({"feature_name": k, "feature_qualifiers": list(map(lambda level: {"operator": "=", "value": level}, levels))})
+    conditions = [filter_condition(table, feature_a["feature_name"], va) for feature_a in feature_as for va in feature_a["feature_qualifiers"]]
+    counts = grouped_counts(conn, table, years, cohort_features, conditions)
+    rs = {}
+    for year in years:
+        total = counts[year][0]
+        if total <= 10:
+            rs[year] = None
+            continue
+        cells = iter(counts[year][1:])
+        rs[year] = {
+            "size": total,
+            "features": [feature_count_result(feature_a, [next(cells) for _ in feature_a["feature_qualifiers"]], total) for feature_a in feature_as]
+        }
     return rs
 
+
+def select_feature_matrix_by_year(conn, table_name, years, cohort_features, feature_a, feature_b):
+    # the contingency table of the cohort in each year, None for years where the cohort has 10 or fewer patients
+    table = tables[table_name]
+    ka = feature_a["feature_name"]
+    vas = feature_a["feature_qualifiers"]
+    kb = feature_b["feature_name"]
+    vbs = feature_b["feature_qualifiers"]
+
+    conditions = [and_(filter_condition(table, kb, vb), filter_condition(table, ka, va)) for vb in vbs for va in vas] + \
+        [filter_condition(table, ka, va) for va in vas] + \
+        [filter_condition(table, kb, vb) for vb in vbs]
+    counts = grouped_counts(conn, table, years, cohort_features, conditions)
+
+    year_counts = []
+    for year in years:
+        total = counts[year][0]
+        if total <= 10:
+            continue
+        cells = counts[year][1:]
+        n = len(vas) * len(vbs)
+        feature_matrix = [cells[i * len(vas):(i + 1) * len(vas)] for i in range(len(vbs))]
+        total_cols = cells[n:n + len(vas)]
+        total_rows = cells[n + len(vas):]
+        year_counts.append((year, (feature_matrix, total_rows, total_cols, total)))
+
+    rs = {year: None for year in years}
+    if len(year_counts) > 0:
+        chi_squared_values, ps = chi_squared(*zip(*[c for _, c in year_counts]))
+        for (year, c), chi_squared_value, p in zip(year_counts, chi_squared_values, ps):
+            rs[year] = feature_matrix_result(table_name, feature_a, feature_b, c, chi_squared_value, p)
+    return rs
+
+
 def validate_range(table_name, feature):
     feature_name = feature["feature_name"]
     values = feature["feature_qualifiers"]
@@ -298,31 +857,43 @@ def validate_range(table_name, feature):
     else:
         print("warning: cannot validate feature " + feature_name + " in table " + table_name + " because its levels are not provided")
            
+# names are never renamed or removed, so a resolved name stays valid in every worker
+name_cache = {}
+
+name_cache_max_size = int(os.environ.get(service_name + "_NAME_CACHE_MAX_SIZE", "10000"))
+
+
+def name_cache_key(conn, table, name):
+    return str(conn.engine.url), table, name
+
+
 def get_id_by_name(conn, table, name):
-    s = select([func.count()]).select_from(name_table).where((name_table.c.name == name) & (name_table.c.table == table))
-    n = conn.execute(s).scalar()
-    if n == 0:
-        raise RuntimeError("Input name invalid. Please try again.")
-    else:
-        s = select([name_table.c.cohort_id]).select_from(name_table).where((name_table.c.name == name) & (name_table.c.table == table))
-        cohort_id = conn.execute(s).scalar()
+    key = name_cache_key(conn, table, name)
+    cohort_id = name_cache.get(key)
+    if cohort_id is None:
+        s = select([name_table.c.cohort_id]).where((name_table.c.name == name) & (name_table.c.table == table))
+        row = conn.execute(s).first()
+        if row is None:
+            raise RuntimeError("Input name invalid. Please try again.")
+        cohort_id = row[0]
+        if len(name_cache) >= name_cache_max_size:
+            name_cache.clear()
+        name_cache[key] = cohort_id
 
-        return {
-            "cohort_id": cohort_id,
-            "name" : name
-        }
+    return {
+        "cohort_id": cohort_id,
+        "name" : name
+    }
 
 def add_name_by_id(conn, table, name, cohort_id):
-    s = select([func.count()]).select_from(name_table).where((name_table.c.name == name) & (name_table.c.table == table))
-    n = conn.execute(s).scalar()
-    if n == 1:
+    # name is the primary key, so of concurrent inserts of a name exactly one succeeds
+    i = insert(name_table).values(name=name, table=table, cohort_id=cohort_id).on_conflict_do_nothing()
+    if conn.execute(i).rowcount == 0:
         raise RuntimeError("Name is already taken. Please choose another name.")
-    else:
-        i = name_table.insert().values(name=name, table=table, cohort_id=cohort_id)
-        conn.execute(i)
+    name_cache.pop(name_cache_key(conn, table, name), None)
 
-        return {
-            "cohort_id": cohort_id,
-            "name" : name
-        }
+    return {
+        "cohort_id": cohort_id,
+        "name" : name
+    }
 
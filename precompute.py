@@ -0,0 +1,94 @@
+import json
+import os
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from cache import ResultCache
+from model import get_db_connection, get_aggregate_connection, get_cohort_features, select_feature_association, to_qualifiers, service_name
+from cost import estimate_queries
+
+# 0 disables precomputation
+precompute_workers = int(os.environ.get(service_name + "_PRECOMPUTE_WORKERS", "0"))
+precompute_max_pending = int(os.environ.get(service_name + "_PRECOMPUTE_MAX_PENDING", "100"))
+precompute_timeout = float(os.environ.get(service_name + "_PRECOMPUTE_TIMEOUT", "600"))
+# features, per table, whose associations to all features are precomputed, as in the associations_to_all_features body
+precompute_associations = json.loads(os.environ.get(service_name + "_PRECOMPUTE_ASSOCIATIONS", "{}"))
+
+results = ResultCache(
+    int(os.environ.get(service_name + "_RESULT_CACHE_MAX_ENTRIES", "1000")),
+    float(os.environ.get(service_name + "_RESULT_CACHE_TTL", "3600"))
+)
+
+executor = None
+
+
+def cache_key(*parts):
+    return json.dumps(parts, sort_keys=True)
+
+
+def features_key(version, table, year, cohort_features):
+    return cache_key("features", version, table, year, cohort_features)
+
+
+def associations_key(version, table, year, cohort_features, feature):
+    return cache_key("associations_to_all_features", version, table, year, cohort_features, feature)
+
+
+def compute_features(version, table, year, cohort_id, cohort_features, deadline=None):
+    conn = get_db_connection(version, precompute_timeout)
+    aggregate_conn, aggregate_cohort_id = get_aggregate_connection(conn, version, precompute_timeout, cohort_id)
+    return get_cohort_features(aggregate_conn, table, year, cohort_features, aggregate_cohort_id, deadline)
+
+
+def compute_associations(version, table, year, cohort_id, cohort_features, feature, deadline=None):
+    # all associations, filtered by maximum p value when served
+    conn = get_db_connection(version, precompute_timeout)
+    aggregate_conn, aggregate_cohort_id = get_aggregate_connection(conn, version, precompute_timeout, cohort_id)
+    return select_feature_association(aggregate_conn, table, year, cohort_features, feature, float("inf"), aggregate_cohort_id, deadline)
+
+
+def run(key, future, admission, queries, function, *args):
+    # with admission, waits for capacity as the requests computing the same result would, args start with the version
+    ticket = None
+    try:
+        if admission is not None:
+            version = args[0]
+            ticket = admission.acquire_waiting(queries, lambda: get_db_connection(version), precompute_timeout)
+        value = function(*args)
+    except Exception as e:
+        traceback.print_exc()
+        results.finish(key, future, exception=e)
+    else:
+        results.finish(key, future, value)
+    finally:
+        if ticket is not None:
+            admission.release(ticket)
+
+
+def compute(key, function, *args):
+    # computes in this thread, unless the result is cached or being computed
+    future = results.start(key)
+    if future is not None:
+        run(key, future, None, 0, function, *args)
+
+
+def submit(key, admission, queries, function, *args):
+    global executor
+    if results.pending() >= precompute_max_pending:
+        return
+    future = results.start(key)
+    if future is None:
+        return
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=precompute_workers)
+    executor.submit(run, key, future, admission, queries, function, *args)
+
+
+def precompute(admission, version, table, year, cohort_id, cohort_features):
+    # starts computing the profile of a cohort, and its associations to the configured features, in the background,
+    # each admitted like the request it serves
+    if precompute_workers <= 0:
+        return
+    submit(features_key(version, table, year, cohort_features), admission, estimate_queries("servfeatures", table, None), compute_features, version, table, year, cohort_id, cohort_features)
+    for feature in precompute_associations.get(table, []):
+        feature = to_qualifiers(feature)
+        submit(associations_key(version, table, year, cohort_features, feature), admission, estimate_queries("servassociationstoallfeatures", table, None), compute_associations, version, table, year, cohort_id, cohort_features, feature)
@@ -0,0 +1,64 @@
+import argparse
+import json
+import resource
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from preprocUtils import preprocess
+import preprocPatient
+import preprocVisit
+
+preprocs = {
+    "patient": preprocPatient.preproc,
+    "visit": preprocVisit.preproc
+}
+
+
+def run_job(job, memory_limit=None):
+    # runs in a worker process, which is reused for several jobs, so the limit is lowered and restored per job
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if memory_limit is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, hard))
+    start = time.time()
+    try:
+        preproc = preprocs[job["table"]]
+        year = str(job["year"])
+        binstr = job["binning"]
+        preprocess(job["input"], job["output"], job.get("chunksize"), lambda df, edges: preproc(df, year, binstr, edges), job["table"])
+        return time.time() - start, None
+    except MemoryError:
+        return time.time() - start, "memory limit exceeded"
+    except Exception:
+        return time.time() - start, traceback.format_exc()
+    finally:
+        resource.setrlimit(resource.RLIMIT_AS, (soft, hard))
+
+
+def run(jobs, workers, memory_limit=None):
+    failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_job, job, memory_limit): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            seconds, error = future.result()
+            if error is None:
+                print("{0} {1} -> {2} in {3:.1f}s".format(job["table"], job["input"], job["output"], seconds))
+            else:
+                failed += 1
+                print("{0} {1} failed after {2:.1f}s: {3}".format(job["table"], job["input"], seconds, error))
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run preprocPatient/preprocVisit jobs listed in a manifest on a process pool")
+    parser.add_argument("manifest", help='json list of jobs {"table": "patient|visit", "input": ..., "output": ..., "year": ..., "binning": "cut|qcut", "chunksize": optional}')
+    parser.add_argument("--workers", type=int, default=4, help="number of worker processes")
+    parser.add_argument("--memory-limit", type=int, help="address space limit per job in MB")
+    args = parser.parse_args()
+
+    with open(args.manifest) as f:
+        jobs = json.load(f)
+
+    start = time.time()
+    failed = run(jobs, args.workers, args.memory_limit * 1024 * 1024 if args.memory_limit is not None else None)
+    print("{0} jobs, {1} failed, in {2:.1f}s".format(len(jobs), failed, time.time() - start))
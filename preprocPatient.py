@@ -1,22 +1,22 @@
-import pandas as pd
 import sys
-from preprocUtils import quantile, preprocSocial
+from preprocUtils import quantile, preprocSocial, preprocess
 
-input_file = sys.argv[1]
-output_file = sys.argv[2]
-year = sys.argv[3]
-binstr = sys.argv[4]
+def preproc(df, year, binstr, edges=None):
+    df["Mepolizumab"] = 0
+    for binning, binstr in [("_qcut", "qcut"), ("", binstr)]:
+        for feature in ["PM2.5", "Ozone"]:
+            for stat in ["Avg", "Max"]:
+                for suffix in ["_StudyAvg", "_StudyMax", ""]:
+                    quantile(df, stat + "Daily" + feature + "Exposure" + suffix, 5, binstr, stat + "Daily" + feature + "Exposure" + suffix + binning, edges)
+    preprocSocial(df, edges)
 
-df = pd.read_csv(input_file)
+    df["year"] = year
 
-df["Mepolizumab"] = 0
-for binning, binstr in [("_qcut", "qcut"), ("", binstr)]:
-    for feature in ["PM2.5", "Ozone"]:
-        for stat in ["Avg", "Max"]:
-            for suffix in ["_StudyAvg", "_StudyMax", ""]:
-                quantile(df, stat + "Daily" + feature + "Exposure" + suffix, 5, binstr, stat + "Daily" + feature + "Exposure" + suffix + binning)
-preprocSocial(df)
+if __name__ == '__main__':
+    input_file = sys.argv[1]
+    output_file = sys.argv[2]
+    year = sys.argv[3]
+    binstr = sys.argv[4]
 
-df["year"] = year
-
-df.to_csv(output_file, index=False)
+    chunksize = int(sys.argv[5]) if len(sys.argv) > 5 else None
+    preprocess(input_file, output_file, chunksize, lambda df, edges: preproc(df, year, binstr, edges), "patient")
@@ -1,30 +1,191 @@
 import pandas as pd
+import numpy as np
+import json
 
-def quantile(df, col, n, bin="qcut", column=None):
+def quantile(df, col, n, bin="qcut", column=None, edges=None):
     if not column:
         column = col
-    if bin == "qcut":
+    if isinstance(edges, EdgeCollector):
+        edges.add(column, col, df[col], n, bin)
+    elif edges is not None:
+        df[column] = pd.cut(df[col], edges[column], labels=list(map(str, range(1,n+1))), include_lowest=(bin == "qcut"))
+    elif bin == "qcut":
         df[column] = pd.qcut(df[col], n, labels=list(map(str, range(1,n+1))))
     elif bin == "cut":
         df[column] = pd.cut(df[col], n, labels=list(map(str, range(1,n+1))))
     else:
         raise "unsupported binning method"
 
+def qcut_edges(values, n):
+    # the same edges pd.qcut computes: linear interpolation over the non-null values
+    return np.quantile(values, np.linspace(0, 1, n + 1))
+
+def cut_edges(mn, mx, n):
+    # the same edges pd.cut computes for an integer number of bins
+    if mn == mx:
+        mn -= 0.001 * abs(mn) if mn != 0 else 0.001
+        mx += 0.001 * abs(mx) if mx != 0 else 0.001
+        return np.linspace(mn, mx, n + 1)
+    else:
+        bins = np.linspace(mn, mx, n + 1)
+        bins[0] -= (mx - mn) * 0.001
+        return bins
+
+class EdgeCollector():
+    """
+    Passed as edges to quantile during the first pass over a chunked input. Records the values
+    each binned column needs, so that the second pass can bin every chunk with the edges
+    pd.qcut/pd.cut would have computed over the whole input.
+    """
+
+    def __init__(self):
+        self.specs = {}
+        self.values = {}
+        self.owners = {}
+        self.ranges = {}
+
+    def add(self, column, col, series, n, bin):
+        if bin not in ["qcut", "cut"]:
+            raise ValueError("unsupported binning method")
+        self.specs[column] = (col, n, bin)
+        values = series.dropna().to_numpy(dtype=float)
+        if bin == "qcut":
+            # several columns may be binned from the same source column, keep its values once
+            if self.owners.setdefault(col, column) == column:
+                self.values.setdefault(col, []).append(values)
+        elif len(values) > 0:
+            mn, mx = self.ranges.get(col, (values.min(), values.max()))
+            self.ranges[col] = (min(mn, values.min()), max(mx, values.max()))
+
+    def edges(self):
+        edges = {}
+        values = {col: np.concatenate(vs) for col, vs in self.values.items()}
+        for column, (col, n, bin) in self.specs.items():
+            if bin == "qcut":
+                edges[column] = qcut_edges(values[col], n)
+            else:
+                edges[column] = cut_edges(*self.ranges[col], n)
+        return edges
+
+def column_dtype(dtypes):
+    dtypes = set(dtypes)
+    if len(dtypes) == 1:
+        return dtypes.pop()
+    elif all(np.issubdtype(ty, np.number) for ty in dtypes):
+        return np.result_type(*dtypes)
+    else:
+        return object
+
+def typed_columns(df, table_name):
+    # small integer columns for binned and boolean features, dictionary encoded columns for the rest
+    from features import features
+    from sqlalchemy import Integer
+    types = {k: (ty, levels) for k, ty, levels, _ in features[table_name]}
+    df = df.copy()
+    for col in df.columns:
+        if col in types:
+            ty, levels = types[col]
+            if ty is Integer:
+                df[col] = pd.to_numeric(df[col].astype(object), errors="coerce").astype("Int8" if levels is not None else "Int32")
+            else:
+                df[col] = df[col].astype("category")
+        elif col == "year":
+            df[col] = pd.to_numeric(df[col]).astype("int16")
+    return df
+
+class OutputWriter():
+    """
+    Writes preprocessed chunks to csv, or to parquet when the output file ends with .parquet. The
+    parquet file uses the column types in features.py and records the bin edges in its metadata.
+    """
+
+    def __init__(self, output_file, table_name, edges=None):
+        self.output_file = output_file
+        self.table_name = table_name
+        self.edges = edges
+        self.parquet = output_file.endswith(".parquet")
+        self.writer = None
+        self.header = True
+
+    def write(self, df):
+        if self.parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            df = typed_columns(df, self.table_name)
+            if self.writer is None:
+                schema = pa.Schema.from_pandas(df, preserve_index=False)
+                metadata = dict(schema.metadata or {})
+                metadata[b"icees"] = json.dumps({
+                    "table": self.table_name,
+                    "bin_edges": {column: list(map(float, edges)) for column, edges in (self.edges or {}).items()}
+                }).encode("utf-8")
+                self.schema = schema.with_metadata(metadata)
+                self.writer = pq.ParquetWriter(self.output_file, self.schema)
+            self.writer.write_table(pa.Table.from_pandas(df, schema=self.schema, preserve_index=False))
+        else:
+            df.to_csv(self.output_file, index=False, header=self.header, mode="w" if self.header else "a")
+        self.header = False
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+def collect_edges(dfs, preproc):
+    collector = EdgeCollector()
+    dtypes = {}
+    for df in dfs:
+        for col, ty in df.dtypes.items():
+            dtypes.setdefault(col, []).append(ty)
+        preproc(df, collector)
+    return collector.edges(), {col: column_dtype(tys) for col, tys in dtypes.items()}
+
+def stream(input_file, output_file, chunksize, preproc, table_name):
+    # first pass: collect bin edges and the dtype each column has over the whole input
+    edges, dtypes = collect_edges(pd.read_csv(input_file, chunksize=chunksize), preproc)
+
+    # second pass: bin and write chunk by chunk
+    writer = OutputWriter(output_file, table_name, edges)
+    for df in pd.read_csv(input_file, chunksize=chunksize, dtype=dtypes):
+        preproc(df, edges)
+        writer.write(df)
+    writer.close()
+    return edges
+
+def preprocess(input_file, output_file, chunksize, preproc, table_name):
+    if chunksize is not None:
+        return stream(input_file, output_file, chunksize, preproc, table_name)
+    df = pd.read_csv(input_file)
+    if output_file.endswith(".parquet"):
+        edges, _ = collect_edges([df.copy()], preproc)
+        preproc(df, edges)
+    else:
+        edges = None
+        preproc(df, None)
+    writer = OutputWriter(output_file, table_name, edges)
+    writer.write(df)
+    writer.close()
+    return edges
+
 def preprocHighwayExposure(i):
     if i < 0:
         return 500
     else:
         return i
 
-def preprocSocial(df):
+social_quantiles = [
+    ("EstResidentialDensity25Plus", 5),
+    ("EstProbabilityNonHispWhite", 4),
+    ("EstProbabilityHouseholdNonHispWhite", 4),
+    ("EstProbabilityHighSchoolMaxEducation", 4),
+    ("EstProbabilityNoAuto", 4),
+    ("EstProbabilityNoHealthIns", 4),
+    ("EstProbabilityESL", 4),
+    ("EstHouseholdIncome", 5)
+]
+
+def preprocSocial(df, edges=None):
     df["EstResidentialDensity"] = pd.cut(df["EstResidentialDensity"], [0,2500,50000,float("inf")], labels=["1","2","3"], include_lowest=True, right=False)
-    quantile(df, "EstResidentialDensity25Plus", 5)
-    quantile(df, "EstProbabilityNonHispWhite", 4)
-    quantile(df, "EstProbabilityHouseholdNonHispWhite", 4)
-    quantile(df, "EstProbabilityHighSchoolMaxEducation", 4)
-    quantile(df, "EstProbabilityNoAuto", 4)
-    quantile(df, "EstProbabilityNoHealthIns", 4)
-    quantile(df, "EstProbabilityESL", 4)
-    quantile(df, "EstHouseholdIncome", 5)
+    for col, n in social_quantiles:
+        quantile(df, col, n, edges=edges)
     df["MajorRoadwayHighwayExposure"] = pd.cut(df["MajorRoadwayHighwayExposure"].apply(preprocHighwayExposure), [0, 50, 100, 200, 300, 500, float("inf")], labels=list(map(str, [1, 2, 3, 4, 5, 6])), include_lowest=True, right=False)
 
@@ -1,25 +1,25 @@
-import pandas as pd
 import sys
-from preprocUtils import quantile, preprocSocial
+from preprocUtils import quantile, preprocSocial, preprocess
 
-input_file = sys.argv[1]
-output_file = sys.argv[2]
-year = sys.argv[3]
-binstr = sys.argv[4]
+def preproc(df, year, binstr, edges=None):
+    df["MepolizumabVisit"] = 0
+    quantile(df, "Avg24hPM2.5Exposure", 5, "qcut", "Avg24hPM2.5Exposure_qcut", edges)
+    quantile(df, "Max24hPM2.5Exposure", 5, "qcut", "Max24hPM2.5Exposure_qcut", edges)
+    quantile(df, "Avg24hOzoneExposure", 5, "qcut", "Avg24hOzoneExposure_qcut", edges)
+    quantile(df, "Max24hOzoneExposure", 5, "qcut", "Max24hOzoneExposure_qcut", edges)
+    quantile(df, "Avg24hPM2.5Exposure", 5, binstr, edges=edges)
+    quantile(df, "Max24hPM2.5Exposure", 5, binstr, edges=edges)
+    quantile(df, "Avg24hOzoneExposure", 5, binstr, edges=edges)
+    quantile(df, "Max24hOzoneExposure", 5, binstr, edges=edges)
+    preprocSocial(df, edges)
 
-df = pd.read_csv(input_file)
+    df["year"] = year
 
-df["MepolizumabVisit"] = 0
-quantile(df, "Avg24hPM2.5Exposure", 5, "qcut", "Avg24hPM2.5Exposure_qcut")
-quantile(df, "Max24hPM2.5Exposure", 5, "qcut", "Max24hPM2.5Exposure_qcut")
-quantile(df, "Avg24hOzoneExposure", 5, "qcut", "Avg24hOzoneExposure_qcut")
-quantile(df, "Max24hOzoneExposure", 5, "qcut", "Max24hOzoneExposure_qcut")
-quantile(df, "Avg24hPM2.5Exposure", 5, binstr)
-quantile(df, "Max24hPM2.5Exposure", 5, binstr)
-quantile(df, "Avg24hOzoneExposure", 5, binstr)
-quantile(df, "Max24hOzoneExposure", 5, binstr)
-preprocSocial(df)
+if __name__ == '__main__':
+    input_file = sys.argv[1]
+    output_file = sys.argv[2]
+    year = sys.argv[3]
+    binstr = sys.argv[4]
 
-df["year"] = year
-
-df.to_csv(output_file, index=False)
+    chunksize = int(sys.argv[5]) if len(sys.argv) > 5 else None
+    preprocess(input_file, output_file, chunksize, lambda df, edges: preproc(df, year, binstr, edges), "visit")
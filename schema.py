@@ -1,7 +1,11 @@
 from features import features
 from sqlalchemy import String, Integer
+from jsonschema.validators import validator_for
 import yaml
 import os
+import json
+
+artifact_path = os.environ.get("ICEES_BUILD_ARTIFACT", "build.json")
 
 def qualifier_schema(ty, levels):
     if ty is String:
@@ -141,7 +145,7 @@ def bins_schema(table_name):
         "properties": {k: {
             "type": "array",
             "items": bin_qualifier_schema(v, levels)
-        } for k, v, levels in features[table_name]},
+        } for k, v, levels, _ in features[table_name]},
         "additionalProperties": False
     }
 
@@ -167,6 +171,18 @@ def associations_to_all_features_schema(table_name):
             "feature": cohort_schema(table_name),
             "maximum_p_value": {
                 "type": "number"
+            },
+            "partial": {
+                "type": "boolean"
+            },
+            "sample_fraction": {
+                "type": "number",
+                "exclusiveMinimum": 0,
+                "maximum": 1
+            },
+            "exact_top": {
+                "type": "integer",
+                "minimum": 0
             }
         },
         "required": ["feature", "maximum_p_value"],
@@ -174,6 +190,61 @@ def associations_to_all_features_schema(table_name):
     }
 
 
+def feature_cube_schema(table_name):
+    feature_schema = bins_schema(table_name)
+    feature_schema["minProperties"] = 1
+    feature_schema["maxProperties"] = 1
+    return {
+        "type": "object",
+        "properties": {
+            "features": {
+                "type": "array",
+                "items": feature_schema,
+                "minItems": 1,
+                # postgres allows at most 31 arguments to GROUPING
+                "maxItems": 31
+            },
+            "marginals": {
+                "type": "array",
+                "items": {
+                    "type": "array",
+                    "items": {
+                        "type": "integer",
+                        "minimum": 0
+                    }
+                }
+            }
+        },
+        "required": ["features"],
+        "additionalProperties": False
+    }
+
+
+def cohort_years_schema(table_name):
+    return {
+        "type": "object",
+        "properties": {
+            "years": {
+                "type": "array",
+                "items": {
+                    "type": "integer"
+                },
+                "minItems": 1,
+                "uniqueItems": True
+            },
+            "cohort_features": cohort_schema(table_name),
+            "feature_a": bins_schema(table_name),
+            "feature_b": bins_schema(table_name)
+        },
+        "required": ["years", "cohort_features"],
+        "dependencies": {
+            "feature_a": ["feature_b"],
+            "feature_b": ["feature_a"]
+        },
+        "additionalProperties": False
+    }
+
+
 def features_schema_output(table_name):
     return {
     }
@@ -204,6 +275,16 @@ def associations_to_all_features_schema_output(table_name):
     }
 
 
+def cohort_years_schema_output(table_name):
+    return {
+    }
+
+
+def feature_cube_schema_output(table_name):
+    return {
+    }
+
+
 def identifiers_output():
     return {
     }
@@ -217,6 +298,52 @@ class ExplicitDumper(yaml.SafeDumper):
     def ignore_aliases(self, data):
         return True
 
+input_schemas = {
+    "cohort": cohort_schema,
+    "feature_association": feature_association_schema,
+    "feature_association2": feature_association2_schema,
+    "associations_to_all_features": associations_to_all_features_schema,
+    "cohort_years": cohort_years_schema,
+    "feature_cube": feature_cube_schema
+}
+
+
+def build_schemas():
+    schemas = {name + "_" + table_name: schema_function(table_name) for name, schema_function in input_schemas.items() for table_name in features}
+    schemas["add_name_by_id"] = add_name_by_id_schema()
+    return schemas
+
+
+artifact = None
+
+def load_artifact():
+    # the schemas and api spec built by build.py, if it has been run
+    global artifact
+    if artifact is None:
+        if os.path.exists(artifact_path):
+            with open(artifact_path) as f:
+                artifact = json.load(f)
+        else:
+            artifact = {}
+    return artifact
+
+
+validators = {}
+
+def validator(name, table_name=None):
+    key = name if table_name is None else name + "_" + table_name
+    if key not in validators:
+        schemas = load_artifact().get("schemas", {})
+        if key in schemas:
+            schema = schemas[key]
+        elif table_name is None:
+            schema = add_name_by_id_schema()
+        else:
+            schema = input_schemas[name](table_name)
+        validators[key] = validator_for(schema)(schema)
+    return validators[key]
+
+
 def generate_schema():
     dir = "definitions"
     if not os.path.exists(dir):
@@ -229,6 +356,10 @@ def generate_schema():
         yaml.dump(feature_association2_schema("patient"), f, Dumper=ExplicitDumper)
     with open(dir + "/associations_to_all_features_patient_input.yaml", "w") as f:
         yaml.dump(associations_to_all_features_schema("patient"), f, Dumper=ExplicitDumper)
+    with open(dir + "/cohort_years_patient_input.yaml", "w") as f:
+        yaml.dump(cohort_years_schema("patient"), f, Dumper=ExplicitDumper)
+    with open(dir + "/feature_cube_patient_input.yaml", "w") as f:
+        yaml.dump(feature_cube_schema("patient"), f, Dumper=ExplicitDumper)
     with open(dir + "/cohort_visit_input.yaml", "w") as f:
         yaml.dump(cohort_schema("visit"), f, Dumper=ExplicitDumper)
     with open(dir + "/feature_association_visit_input.yaml", "w") as f:
@@ -237,6 +368,10 @@ def generate_schema():
         yaml.dump(feature_association2_schema("visit"), f, Dumper=ExplicitDumper)
     with open(dir + "/associations_to_all_features_visit_input.yaml", "w") as f:
         yaml.dump(associations_to_all_features_schema("visit"), f, Dumper=ExplicitDumper)
+    with open(dir + "/cohort_years_visit_input.yaml", "w") as f:
+        yaml.dump(cohort_years_schema("visit"), f, Dumper=ExplicitDumper)
+    with open(dir + "/feature_cube_visit_input.yaml", "w") as f:
+        yaml.dump(feature_cube_schema("visit"), f, Dumper=ExplicitDumper)
     with open(dir + "/add_name_by_id_input.yaml", "w") as f:
         yaml.dump(add_name_by_id_schema(), f, Dumper=ExplicitDumper)
     with open(dir + "/features_patient_output.yaml", "w") as f:
@@ -251,6 +386,10 @@ def generate_schema():
         yaml.dump(feature_association2_schema_output("patient"), f, Dumper=ExplicitDumper)
     with open(dir + "/associations_to_all_features_patient_output.yaml", "w") as f:
         yaml.dump(associations_to_all_features_schema_output("patient"), f, Dumper=ExplicitDumper)
+    with open(dir + "/cohort_years_patient_output.yaml", "w") as f:
+        yaml.dump(cohort_years_schema_output("patient"), f, Dumper=ExplicitDumper)
+    with open(dir + "/feature_cube_patient_output.yaml", "w") as f:
+        yaml.dump(feature_cube_schema_output("patient"), f, Dumper=ExplicitDumper)
     with open(dir + "/cohort_visit_output.yaml", "w") as f:
         yaml.dump(cohort_schema_output("visit"), f, Dumper=ExplicitDumper)
     with open(dir + "/features_visit_output.yaml", "w") as f:
@@ -263,6 +402,10 @@ def generate_schema():
         yaml.dump(feature_association2_schema_output("visit"), f, Dumper=ExplicitDumper)
     with open(dir + "/associations_to_all_features_visit_output.yaml", "w") as f:
         yaml.dump(associations_to_all_features_schema_output("visit"), f, Dumper=ExplicitDumper)
+    with open(dir + "/cohort_years_visit_output.yaml", "w") as f:
+        yaml.dump(cohort_years_schema_output("visit"), f, Dumper=ExplicitDumper)
+    with open(dir + "/feature_cube_visit_output.yaml", "w") as f:
+        yaml.dump(feature_cube_schema_output("visit"), f, Dumper=ExplicitDumper)
     with open(dir + "/name_output.yaml", "w") as f:
         yaml.dump(name_schema_output(), f, Dumper=ExplicitDumper)
     with open(dir + "/identifiers_output.yaml", "w") as f:
@@ -0,0 +1,41 @@
+import numpy as np
+
+
+def pad_tables(tables):
+    n = len(tables)
+    nrows = max([len(table) for table in tables] + [0])
+    ncols = max([len(row) for table in tables for row in table] + [0])
+    observed = np.zeros((n, nrows, ncols))
+    mask = np.zeros((n, nrows, ncols), dtype=bool)
+    for i, table in enumerate(tables):
+        for j, row in enumerate(table):
+            observed[i, j, :len(row)] = row
+            mask[i, j, :len(row)] = True
+    return observed, mask
+
+
+def pad_vectors(vectors, size):
+    padded = np.zeros((len(vectors), size))
+    for i, vector in enumerate(vectors):
+        padded[i, :len(vector)] = vector
+    return padded
+
+
+def chi_squared(observed_tables, row_totals, column_totals, totals):
+    # observed_tables is a list of (possibly differently shaped) contingency tables. The expected
+    # frequency of a cell is row total * column total / total, using the margins as counted rather
+    # than the sums of the table, and a zero total yields NaN expected frequencies, as in chisquare.
+    from scipy.stats import chi2
+    observed, mask = pad_tables(observed_tables)
+    rows = pad_vectors(row_totals, observed.shape[1])
+    columns = pad_vectors(column_totals, observed.shape[2])
+    totals = np.asarray(totals, dtype=float)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        expected = rows[:, :, None] * columns[:, None, :] / totals[:, None, None]
+        terms = (observed - expected) ** 2 / expected
+
+    statistics = np.where(mask, terms, 0).sum(axis=(1, 2))
+    dof = mask.sum(axis=(1, 2)) - 1
+    p_values = chi2.sf(statistics, dof)
+    return statistics.tolist(), p_values.tolist()
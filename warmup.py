@@ -0,0 +1,127 @@
+import argparse
+import glob
+import json
+import os
+import re
+import time
+import traceback
+from collections import Counter
+from model import get_db_connection, get_features_by_id, get_ids_by_feature, get_feature_levels, tables, to_qualifiers, service_name, deadline_statements
+from deadline import Deadline
+from features import features
+from precompute import compute, compute_features, compute_associations, features_key, associations_key
+
+warmup_top = int(os.environ.get(service_name + "_WARMUP_TOP", "20"))
+warmup_max_lines = int(os.environ.get(service_name + "_WARMUP_MAX_LINES", "100000"))
+warmup_timeout = float(os.environ.get(service_name + "_WARMUP_TIMEOUT", "60"))
+
+cohort_path = re.compile(r"^/([^/]+)/([^/]+)/(\d+)/cohort$")
+features_path = re.compile(r"^/([^/]+)/([^/]+)/(\d+)/cohort/([^/]+)/features$")
+associations_path = re.compile(r"^/([^/]+)/([^/]+)/(\d+)/cohort/([^/]+)/associations_to_all_features$")
+
+
+def log_files(log_path):
+    # the log and its rotated files, newest first
+    return sorted(glob.glob(glob.escape(log_path) + "*"), key=os.path.getmtime, reverse=True)
+
+
+def read_requests(log_path, max_lines):
+    # the most recent successful requests, newest first
+    n = 0
+    for filename in log_files(log_path):
+        with open(filename) as f:
+            lines = f.readlines()
+        for line in reversed(lines):
+            if n >= max_lines:
+                return
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get("event") == "request" and str(entry.get("response_status", "")).startswith("2"):
+                n += 1
+                yield entry
+
+
+def frequent_requests(entries, top):
+    # counts the cohort definitions, feature profiles and associations to all features requested, keyed as json
+    counts = Counter()
+    for entry in entries:
+        path = (entry.get("full_path") or "").split("?")[0]
+        data = entry.get("data")
+        m = cohort_path.match(path)
+        if m is not None and entry.get("method") == "POST":
+            version, table, year = m.groups()
+            counts[json.dumps(["cohort", version, table, int(year), data or {}], sort_keys=True)] += 1
+            continue
+        m = features_path.match(path)
+        if m is not None:
+            version, table, year, cohort_id = m.groups()
+            counts[json.dumps(["features", version, table, int(year), cohort_id], sort_keys=True)] += 1
+            continue
+        m = associations_path.match(path)
+        if m is not None and isinstance(data, dict) and "feature" in data and data.get("sample_fraction") is None:
+            version, table, year, cohort_id = m.groups()
+            counts[json.dumps(["associations", version, table, int(year), cohort_id, data["feature"]], sort_keys=True)] += 1
+    return [json.loads(key) for key, _ in counts.most_common(top)]
+
+
+def warm_feature_levels(conn, table, year):
+    for k, _, levels, _ in features[table]:
+        if levels is None:
+            get_feature_levels(conn, tables[table], year, k)
+
+
+def warm(request, deadline):
+    kind, version, table, year = request[:4]
+    if table not in tables:
+        return
+    conn = get_db_connection(version, warmup_timeout)
+    warm_feature_levels(conn, table, year)
+    if kind == "cohort":
+        cohort_id, size = get_ids_by_feature(conn, table, year, request[4])
+        if size != -1:
+            compute(features_key(version, table, year, request[4]), compute_features, version, table, year, cohort_id, request[4], deadline)
+        return
+    cohort_id = request[4]
+    cohort_features = get_features_by_id(conn, table, year, cohort_id)
+    if cohort_features is None:
+        return
+    if kind == "features":
+        compute(features_key(version, table, year, cohort_features), compute_features, version, table, year, cohort_id, cohort_features, deadline)
+    else:
+        feature = to_qualifiers(request[5])
+        compute(associations_key(version, table, year, cohort_features, feature), compute_associations, version, table, year, cohort_id, cohort_features, feature, deadline)
+
+
+def warmup(log_path=None, top=warmup_top, max_lines=warmup_max_lines, timeout=warmup_timeout):
+    # fills this process's result and feature level caches with the most frequent recent requests in the log
+    log_path = log_path or os.environ.get(service_name + "_API_LOG_PATH")
+    if log_path is None:
+        return 0
+    # the deadline is checked between features and caps each statement, so warm-up ends within timeout seconds
+    deadline = Deadline(timeout)
+    n = 0
+    with deadline_statements(deadline):
+        for request in frequent_requests(read_requests(log_path, max_lines), top):
+            if deadline.remaining() <= 0:
+                break
+            try:
+                warm(request, deadline)
+                n += 1
+            except Exception:
+                traceback.print_exc()
+    return n
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the most frequent recent requests in the log, warming the database's caches")
+    parser.add_argument("--log", help="log path, default " + service_name + "_API_LOG_PATH")
+    parser.add_argument("--top", type=int, default=warmup_top, help="number of requests")
+    parser.add_argument("--max-lines", type=int, default=warmup_max_lines, help="number of recent requests to read")
+    parser.add_argument("--timeout", type=float, default=warmup_timeout, help="seconds")
+    args = parser.parse_args()
+
+    start = time.time()
+    n = warmup(args.log, args.top, args.max_lines, args.timeout)
+    print("warmed {0} requests in {1:.1f}s".format(n, time.time() - start))